@@ -0,0 +1,242 @@
+##
+#
+# Bake benchmark on synthetic meshes, per stage timings are written to a json file
+# python benchmarks/bench_bake.py --meshes torus sphere --sizes 10000 100000 --output bench.json
+#
+##
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from time import perf_counter
+
+import numpy as np
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+parent_path = os.path.abspath(os.path.join(current_path, os.pardir))
+sys.path.insert(0, parent_path)
+
+from pynanite import __version__, lod_graph, utils  # noqa: E402
+
+MAX_LODS = 40
+
+# Stages of the bake (the others are part of next_lod)
+TOTAL_STAGES = ["load_obj", "group_tris", "next_lod", "dag_finalization", "texturing"]
+
+
+def grid_mesh(num_tris):
+    # Open, flat grid (borders are preserved during simplification, the LODs can stall)
+    n = max(int(np.sqrt(num_tris / 2)), 1) + 1
+    u, v = np.meshgrid(np.linspace(0, 1, n), np.linspace(0, 1, n))
+    vertices = np.stack([u, np.zeros_like(u), v], axis=-1).reshape(-1, 3)
+
+    ids = np.arange(n * n).reshape(n, n)
+    a, b, c, d = ids[:-1, :-1], ids[:-1, 1:], ids[1:, :-1], ids[1:, 1:]
+    tris = np.concatenate([
+        np.stack([a, c, b], axis=-1).reshape(-1, 3),
+        np.stack([b, c, d], axis=-1).reshape(-1, 3),
+    ])
+    normals = np.tile([0.0, 1.0, 0.0], (len(vertices), 1))
+    return vertices, tris, np.stack([u, v], axis=-1).reshape(-1, 2), normals
+
+
+def uv_sphere_mesh(num_tris):
+    # Closed sphere, poles are single vertices
+    rings = max(int(np.sqrt(num_tris / 4)), 2)
+    segments = 2 * rings
+    theta = np.linspace(0, np.pi, rings + 1)[1:-1]
+    phi = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    t, p = np.meshgrid(theta, phi, indexing="ij")
+    ring_vertices = np.stack([np.sin(t) * np.cos(p), np.cos(t), np.sin(t) * np.sin(p)], axis=-1)
+    vertices = np.concatenate([[[0, 1, 0]], ring_vertices.reshape(-1, 3), [[0, -1, 0]]])
+    ring_uvs = np.stack([p / (2 * np.pi), 1 - t / np.pi], axis=-1).reshape(-1, 2)
+    uvs = np.concatenate([[[0.5, 1]], ring_uvs, [[0.5, 0]]])
+
+    ids = 1 + np.arange((rings - 1) * segments).reshape(rings - 1, segments)
+    right = np.roll(ids, -1, axis=1)
+    bottom = len(vertices) - 1
+    tris = [
+        np.stack([np.zeros(segments, dtype=int), right[0], ids[0]], -1),
+        np.stack([ids[:-1], right[:-1], ids[1:]], -1).reshape(-1, 3),
+        np.stack([right[:-1], right[1:], ids[1:]], -1).reshape(-1, 3),
+        np.stack([ids[-1], right[-1], np.full(segments, bottom)], -1),
+    ]
+    return vertices, np.concatenate(tris), uvs, vertices
+
+
+def noisy_torus_mesh(num_tris, radii=(1.0, 0.4), noise=0.01, seed=0):
+    # Closed torus, vertices displaced along the normals
+    n_v = max(int(np.sqrt(num_tris / 2 / 2.5)), 3)
+    n_u = max(int(num_tris / 2 / n_v), 3)
+    u, v = np.meshgrid(
+        np.linspace(0, 2 * np.pi, n_u, endpoint=False),
+        np.linspace(0, 2 * np.pi, n_v, endpoint=False),
+    )
+    normals = np.stack([np.cos(v) * np.cos(u), np.sin(v), np.cos(v) * np.sin(u)], axis=-1)
+    offsets = radii[1] + np.random.default_rng(seed).normal(0, noise, u.shape)
+    centers = np.stack([radii[0] * np.cos(u), np.zeros_like(u), radii[0] * np.sin(u)], axis=-1)
+    vertices = (centers + normals * offsets[..., None]).reshape(-1, 3)
+
+    ids = np.arange(n_u * n_v).reshape(n_v, n_u)
+    right = np.roll(ids, -1, axis=1)
+    up = np.roll(ids, -1, axis=0)
+    up_right = np.roll(right, -1, axis=0)
+    tris = np.concatenate([
+        np.stack([ids, up, right], axis=-1).reshape(-1, 3),
+        np.stack([right, up, up_right], axis=-1).reshape(-1, 3),
+    ])
+    uvs = np.stack([u / (2 * np.pi), v / (2 * np.pi)], axis=-1).reshape(-1, 2)
+    return vertices, tris, uvs, normals.reshape(-1, 3)
+
+
+MESHES = {"grid": grid_mesh, "sphere": uv_sphere_mesh, "torus": noisy_torus_mesh}
+
+
+def write_obj(path, vertices, tris, uvs, normals):
+    # Vertex, texture coord and normal ids are the same
+    with open(path, "w") as f:
+        np.savetxt(f, vertices, fmt="v %.6f %.6f %.6f")
+        np.savetxt(f, uvs, fmt="vt %.6f %.6f")
+        np.savetxt(f, normals, fmt="vn %.6f %.6f %.6f")
+        corners = np.repeat(tris + 1, 3, axis=1)
+        np.savetxt(f, corners, fmt="f %d/%d/%d %d/%d/%d %d/%d/%d")
+
+
+class StageTimer:
+    """Accumulates the time spent in wrapped functions of a module (by stage name)."""
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.wrapped = []
+
+    def wrap(self, module, name, stage=None):
+        func = getattr(module, name)
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.times[stage or name] += perf_counter() - start
+
+        setattr(module, name, timed)
+        self.wrapped.append((module, name, func))
+
+    def restore(self):
+        for module, name, func in reversed(self.wrapped):
+            setattr(module, name, func)
+        self.wrapped = []
+
+
+def bake(obj_path, config):
+    # The bake of LODGraph.__init__, stage by stage (no texture upload, no file output)
+    timer = StageTimer()
+    timer.wrap(lod_graph, "group_clusters")
+    timer.wrap(lod_graph, "simplify_group")
+    timer.wrap(lod_graph, "combine_group_lods")
+    timer.wrap(lod_graph.RMSErrorIndex, "rms_errors", "geometric_error")
+    stages = timer.times
+
+    try:
+        start = perf_counter()
+        vertices, tris, texture_coords, normals = utils.load_obj(obj_path, use_cache=False)
+        stages["load_obj"] = perf_counter() - start
+
+        start = perf_counter()
+        adjacencies, clusters = utils.group_tris(tris, config["cluster_size_initial"])
+        stages["group_tris"] = perf_counter() - start
+
+        lods = [[vertices, tris, adjacencies, clusters, [np.arange(clusters.max() + 1)], [0], normals]]
+        stalled = False
+        start = perf_counter()
+        while lods[-1][3].max() > 0:
+            lods.append(lod_graph.next_lod(lods[-1], config))
+            # Open meshes: Preserved borders can stop the simplification
+            if lods[-1][3].max() >= lods[-2][3].max() or len(lods) > MAX_LODS:
+                stalled = True
+                break
+        stages["next_lod"] = perf_counter() - start
+
+        result = {"lods": len(lods), "stalled": stalled}
+        if not stalled:
+            start = perf_counter()
+            dag = lod_graph.build_cluster_dag(lods)
+            stages["dag_finalization"] = perf_counter() - start
+            result["clusters"] = len(dag[0])
+
+            start = perf_counter()
+            tree = lod_graph.lod0_tree(vertices)
+            utils.transfer_texture_coords(tree, texture_coords, np.concatenate(dag[2][1:]))
+            stages["texturing"] = perf_counter() - start
+    finally:
+        timer.restore()
+
+    result["stages"] = dict(stages)
+    result["total"] = sum(time for stage, time in stages.items() if stage in TOTAL_STAGES)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=parent_path, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark baking of synthetic meshes.")
+    parser.add_argument("--meshes", nargs="+", choices=list(MESHES), default=["torus", "sphere", "grid"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000, 500000, 2000000])
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--cluster-size-initial", type=int, default=160)
+    parser.add_argument("--cluster-size", type=int, default=128)
+    parser.add_argument("--group-size", type=int, default=8)
+    args = parser.parse_args(args)
+
+    config = {
+        "cluster_size_initial": args.cluster_size_initial,
+        "cluster_size": args.cluster_size,
+        "group_size": args.group_size,
+    }
+    report = {
+        "commit": git_commit(),
+        "version": __version__,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "results": [],
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for mesh in args.meshes:
+            for size in args.sizes:
+                vertices, tris, uvs, normals = MESHES[mesh](size)
+                obj_path = os.path.join(directory, f"{mesh}_{size}.obj")
+                write_obj(obj_path, vertices, tris, uvs, normals)
+
+                result = {"mesh": mesh, "size": size, "tris": len(tris)}
+                result.update(bake(obj_path, config))
+                report["results"].append(result)
+                os.remove(obj_path)
+
+                stages = " | ".join(f"{stage} {time:.2f}s" for stage, time in result["stages"].items())
+                stalled = " (stalled)" if result["stalled"] else ""
+                print(f"{mesh} {len(tris)} tris: {result['total']:.2f}s{stalled}")
+                print(f"    {stages}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,7 @@ MODELS = {
     "cat": [
         "data/cat/cat.obj",
         "data/cat/cat.jpg",
-        "data/build/cat.pickle",
+        "data/build/cat.bake",
     ]
 }
 
@@ -22,6 +22,9 @@ if __name__ == "__main__":
         MODELS,
         # force_mesh_build=True,
         # profile_meshing=True,
+        # num_workers=8,  # Parallel baking (None: all cores)
+        # quantize_error=1e-4,  # Store 16 bit clusters (max position error, model is scaled to 0-1)
+        # residency_budget=256 * 1024**2,  # Load clusters on demand (bytes of cluster geometry in memory)
         cluster_size_initial=160,
         cluster_size=128,
         group_size=8
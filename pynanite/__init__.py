@@ -1,5 +1,21 @@
-from .camera import Camera
-from .lod_mesh import LODMesh
-from .lod_graph import LODGraph
+__version__ = "0.1.0"
 
-__version__ = "0.1.0"
\ No newline at end of file
+# Submodules are imported on first access: Baking (pynanite.bake) works without OpenGL
+_exports = {
+    "Camera": ".camera",
+    "LODMesh": ".lod_mesh",
+    "LODGraph": ".lod_graph",
+    "BakeCache": ".bake_cache",
+    "ResidencyManager": ".residency",
+    "CutSelector": ".cut_selector",
+    "AsyncCutSelector": ".cut_selector",
+    "LODUpdateScheduler": ".lod_scheduler",
+    "SceneGrid": ".scene",
+}
+
+
+def __getattr__(name):
+    if name in _exports:
+        from importlib import import_module
+        return getattr(import_module(_exports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
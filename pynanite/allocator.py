@@ -0,0 +1,54 @@
+from bisect import bisect_left, insort
+
+
+class RangeAllocator:
+    """First fit allocation of ranges in a buffer of fixed capacity (elements, not bytes).
+
+    Free ranges are kept sorted by start, neighbours are merged when a range is freed.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.free_starts = [0] if capacity > 0 else []
+        self.free_sizes = {0: capacity} if capacity > 0 else {}
+        self.used = 0
+
+    def allocate(self, size):
+        # Start of the range or None if there is no free range large enough
+        for i, start in enumerate(self.free_starts):
+            free_size = self.free_sizes[start]
+            if free_size < size:
+                continue
+
+            del self.free_sizes[start]
+            if free_size == size:
+                del self.free_starts[i]
+            else:
+                self.free_starts[i] = start + size
+                self.free_sizes[start + size] = free_size - size
+            self.used += size
+            return start
+        return None
+
+    def free(self, start, size):
+        self.used -= size
+        i = bisect_left(self.free_starts, start)
+
+        # Merge with the following and the preceding free range
+        if i < len(self.free_starts) and self.free_starts[i] == start + size:
+            size += self.free_sizes.pop(self.free_starts.pop(i))
+        if i > 0:
+            previous = self.free_starts[i - 1]
+            if previous + self.free_sizes[previous] == start:
+                self.free_sizes[previous] += size
+                return
+
+        insort(self.free_starts, start)
+        self.free_sizes[start] = size
+
+    def fragmentation(self):
+        # Fraction of the capacity that is free, but not part of the largest free range
+        if self.capacity == 0:
+            return 0.0
+        largest = max(self.free_sizes.values(), default=0)
+        return (self.capacity - self.used - largest) / self.capacity
@@ -0,0 +1,35 @@
+"""Bake a model without a display: python -m pynanite.bake model.obj texture.jpg model.bake"""
+import argparse
+
+from .bake_cache import BakeCache
+from .lod_graph import LODGraph
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Bake the LOD graph of a model (no OpenGL required).")
+    parser.add_argument("obj_path")
+    parser.add_argument("texture_path")
+    parser.add_argument("build_path")
+    parser.add_argument("--force", action="store_true", help="Rebake even if the build is up to date")
+    parser.add_argument("--cache-dir", help="Content-addressed bake cache (e.g. data/build/cache)")
+    parser.add_argument("--cluster-size-initial", type=int, default=160)
+    parser.add_argument("--cluster-size", type=int, default=128)
+    parser.add_argument("--group-size", type=int, default=8)
+    parser.add_argument("--num-workers", type=int, default=1, help="Parallel workers (0: all cores)")
+    parser.add_argument("--quantize-error", type=float, help="Store quantized clusters (max position error)")
+    args = parser.parse_args(args)
+
+    LODGraph(
+        [args.obj_path, args.texture_path, args.build_path],
+        args.force,
+        args.cluster_size_initial,
+        args.cluster_size,
+        args.group_size,
+        args.num_workers or None,
+        BakeCache(args.cache_dir) if args.cache_dir else None,
+        args.quantize_error,
+    )
+
+
+if __name__ == "__main__":
+    main()
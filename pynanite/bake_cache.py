@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import shutil
+
+from . import __version__
+
+
+class BakeCache:
+    """Baked models stored by content: Hash of source mesh and texture bytes, bake config and version.
+
+    Entries are evicted least recently used first once the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=4 * 1024**3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        # Memo of file hashes by (size, mtime): A cache hit does not need to read the sources
+        self.hashes_path = os.path.join(directory, "hashes.json")
+        try:
+            with open(self.hashes_path) as f:
+                self.hashes = json.load(f)
+        except (OSError, ValueError):
+            self.hashes = {}
+
+    def key(self, paths, config):
+        # Cache key of a bake, paths are the source files (obj, texture)
+        key = hashlib.sha256()
+        for path in paths:
+            key.update(self.file_hash(path).encode())
+        key.update(json.dumps(config, sort_keys=True).encode())
+        key.update(__version__.encode())
+        return key.hexdigest()
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        source_key = [stat.st_size, stat.st_mtime_ns]
+
+        memo = self.hashes.get(path)
+        if memo is not None and memo[0] == source_key:
+            return memo[1]
+
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                file_hash.update(chunk)
+        file_hash = file_hash.hexdigest()
+
+        self.hashes[path] = [source_key, file_hash]
+        self._write_atomic(self.hashes_path, json.dumps(self.hashes).encode())
+        return file_hash
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ".bake")
+
+    def get(self, key):
+        # Path of the cached bake or None, a hit marks the entry as recently used
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def put(self, key, path):
+        # Copy a baked file into the cache, then evict old entries
+        with open(path, "rb") as f:
+            self._write_atomic(self.entry_path(key), f)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".bake"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        # Oldest first, the newest entry is always kept
+        entries.sort()
+        total_size = sum(entry[1] for entry in entries)
+        for __, size, name in entries[:-1]:
+            if total_size <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total_size -= size
+
+    def _write_atomic(self, path, data):
+        # Write to a temporary file first, entries only appear once they are complete
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp_path, "wb") as f:
+            if isinstance(data, bytes):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f)
+        os.replace(temp_path, path)
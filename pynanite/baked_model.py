@@ -0,0 +1,128 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+# Flat binary file of a baked model:
+#   magic, header size (uint32), json header (array dtypes, shapes and offsets, meta data)
+#   followed by the arrays, each contiguous and aligned
+MAGIC = b"PYNANITE"
+FORMAT_VERSION = 2
+ALIGNMENT = 64
+
+
+def write_baked_model(path, arrays, meta):
+    # arrays: name -> numpy array, meta: json serializable
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    # Header size depends on the offsets: Reserve enough space for the largest possible offsets
+    layout = {name: [array.dtype.str, array.shape, 0] for name, array in arrays.items()}
+    header = {"version": FORMAT_VERSION, "meta": meta, "arrays": layout}
+    reserved = len(json.dumps(header)) + 20 * len(arrays) + len(MAGIC) + 4
+
+    offset = _align(reserved)
+    for name, array in arrays.items():
+        layout[name][2] = offset
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps(header).encode()
+    assert len(MAGIC) + 4 + len(header) <= reserved
+
+    # Write to a temporary file first, the baked model only appears once it is complete
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(layout[name][2])
+            f.write(array.tobytes())
+        f.truncate(offset)
+    os.replace(temp_path, path)
+
+
+def read_baked_model(path):
+    # Returns (arrays, meta), arrays are read-only views into a memory map of the file
+    # Raises ValueError if the file is not a baked model of this version
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a baked model: %s" % path)
+        header_size = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(header_size))
+
+    if header["version"] != FORMAT_VERSION:
+        raise ValueError("Unsupported baked model version %d: %s" % (header["version"], path))
+
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=data, offset=offset)
+
+    return arrays, header["meta"]
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def quantize_attributes(vertex_offsets, verts, normals, textures, centers, radii, max_error):
+    # Positions: uint16 grid spanning the bounding box of each cluster's sphere (max error is half a
+    # grid step). Normals: octahedral, 2 x int16. Texture coords: uint16 between min and max.
+    # Returns None if the position error of any cluster would exceed max_error.
+    steps = position_steps(radii)
+    if np.any(steps / 2 > max_error):
+        return None
+
+    cluster_ids = np.repeat(np.arange(len(radii)), np.diff(vertex_offsets))
+    box_min = (centers - radii[:, None])[cluster_ids]
+    quantized_verts = (verts - box_min) / steps[cluster_ids, None]
+    quantized_verts = np.clip(np.round(quantized_verts), 0, 65535).astype(np.uint16)
+
+    uv_min, uv_max = (textures.min(axis=0), textures.max(axis=0)) if len(textures) else (0, 1)
+    uv_scale = np.maximum(uv_max - uv_min, 1e-12) / 65535 * np.ones(2)
+    uv_min = uv_min * np.ones(2)
+    quantized_textures = np.round((textures - uv_min) / uv_scale).astype(np.uint16)
+
+    arrays = {
+        "verts": quantized_verts,
+        "normals": octahedral_encode(normals),
+        "textures": quantized_textures,
+    }
+    meta = {"uv_min": uv_min.tolist(), "uv_scale": uv_scale.tolist()}
+    return arrays, meta
+
+
+def position_steps(radii):
+    return np.maximum(2 * radii, 1e-12) / 65535
+
+
+def dequantize_attributes(vertex_offsets, arrays, centers, radii, meta):
+    # Decode quantized attributes (see quantize_attributes), returns float32 verts, normals, textures
+    cluster_ids = np.repeat(np.arange(len(radii)), np.diff(vertex_offsets))
+    box_min = (centers - radii[:, None])[cluster_ids]
+    steps = position_steps(radii)[cluster_ids, None]
+    verts = (box_min + arrays["verts"] * steps).astype(np.float32)
+    normals = octahedral_decode(arrays["normals"])
+    textures = (meta["uv_min"] + arrays["textures"] * np.array(meta["uv_scale"])).astype(np.float32)
+    return verts, normals, textures
+
+
+def octahedral_encode(normals):
+    # Unit vectors to 2 x int16 (projection onto an octahedron, lower half folded outwards)
+    normals = np.asarray(normals, dtype=np.float64)
+    xy = normals[:, :2] / np.maximum(np.abs(normals).sum(axis=1), 1e-12)[:, None]
+    lower = normals[:, 2] < 0
+    xy[lower] = (1 - np.abs(xy[lower][:, ::-1])) * np.where(xy[lower] >= 0, 1, -1)
+    return np.round(xy * 32767).astype(np.int16)
+
+
+def octahedral_decode(encoded):
+    xy = encoded.astype(np.float32) / 32767
+    z = 1 - np.abs(xy).sum(axis=1)
+    # Unfold the lower half
+    fold = np.maximum(-z, 0)[:, None]
+    xy -= np.where(xy >= 0, fold, -fold)
+    normals = np.column_stack([xy, z])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+    return normals
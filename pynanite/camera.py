@@ -1,18 +1,26 @@
+import copy
+
 import numpy as np
 from OpenGL.GL import glLoadIdentity, glFlush
 from OpenGL.GLU import gluLookAt
 
 class Camera:
-    def __init__(self):
+    def __init__(self, fov=45.0, aspect_ratio=16 / 9, near=0.1, far=200.0):
+        # Projection as set by gluPerspective (vertical fov in degrees)
+        self.fov = fov
+        self.aspect_ratio = aspect_ratio
+        self.near = near
+        self.far = far
+
         self.position = np.array([0, 3, -4], dtype=np.float32)
         self.look_angle = [3.8, -0.3]
-        self.cos_half_fov = np.cos(np.pi / 4)
         self.forward = self._get_forward_vector()
+        self.frustum_planes = self._get_frustum_planes()
 
     def _get_forward_vector(self):
         return np.array([
             -np.sin(self.look_angle[0]) * np.cos(self.look_angle[1]),
-            np.sin(self.look_angle[1]), 
+            np.sin(self.look_angle[1]),
             -np.cos(self.look_angle[0]) * np.cos(self.look_angle[1])])
 
     def update(self, delta_pos, delta_angle):
@@ -20,11 +28,44 @@ class Camera:
         self.look_angle -= delta_angle
         glLoadIdentity()
         self.forward = self._get_forward_vector()
+        self.frustum_planes = self._get_frustum_planes()
         gluLookAt(*self.position, *(self.position + self.forward), 0, 1, 0)
         glFlush()
 
-    def check_in_front(self, world_positions):
-        directions = world_positions - self.position
-        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
-        dot_products = np.dot(directions, self.forward)
-        return dot_products > self.cos_half_fov
\ No newline at end of file
+    def snapshot(self):
+        # Copy of the view for other threads (the camera is updated in place)
+        camera = copy.copy(self)
+        camera.position = self.position.copy()
+        camera.forward = self.forward.copy()
+        return camera
+
+    def projection_matrix(self):
+        # Same as gluPerspective
+        f = 1 / np.tan(np.radians(self.fov) / 2)
+        near, far = self.near, self.far
+        return np.array([
+            [f / self.aspect_ratio, 0, 0, 0],
+            [0, f, 0, 0],
+            [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+            [0, 0, -1, 0],
+        ])
+
+    def view_matrix(self):
+        # Same as gluLookAt (up is +y)
+        forward = self.forward / np.linalg.norm(self.forward)
+        side = np.cross(forward, [0, 1, 0])
+        side /= np.linalg.norm(side)
+        up = np.cross(side, forward)
+        rotation = np.array([side, up, -forward])
+        return np.block([[rotation, -rotation @ self.position[:, None]], [np.zeros((1, 3)), 1]])
+
+    def _get_frustum_planes(self):
+        # Left, right, bottom, top, near, far: (normal, offset), normals point inwards and are normalized
+        m = self.projection_matrix() @ self.view_matrix()
+        planes = np.array([m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1], m[3] + m[2], m[3] - m[2]])
+        return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+    def check_spheres_in_frustum(self, centers, radii):
+        # Spheres at least partially inside the view frustum (any shape, coordinates in the last axis)
+        distances = centers @ self.frustum_planes[:, :3].T + self.frustum_planes[:, 3]
+        return np.all(distances > -np.asarray(radii)[..., None], axis=-1)
@@ -1,103 +1,243 @@
 import numpy as np
-from OpenGL.arrays import vbo
 from OpenGL.GL import (
     glEnable, glDisable, glBindTexture, glEnableClientState, glDisableClientState,
-    glTexCoordPointer, glNormalPointer, glVertexPointer, glDrawArrays, 
-    GL_TEXTURE_2D, GL_FLOAT, GL_VERTEX_ARRAY, GL_TEXTURE_COORD_ARRAY, 
-    GL_NORMAL_ARRAY, GL_TRIANGLES
+    glTexCoordPointer, glNormalPointer, glVertexPointer, glMultiDrawElementsBaseVertex,
+    glGenBuffers, glDeleteBuffers, glBindBuffer, glBufferData, glBufferSubData, glCopyBufferSubData,
+    GL_TEXTURE_2D, GL_FLOAT, GL_VERTEX_ARRAY, GL_TEXTURE_COORD_ARRAY, GL_NORMAL_ARRAY,
+    GL_TRIANGLES, GL_ARRAY_BUFFER, GL_ELEMENT_ARRAY_BUFFER, GL_UNSIGNED_INT, GL_DYNAMIC_DRAW,
+    GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER
 )
 
-
-class ClusterMesh:
-    """Drawing a mesh with multiple clusters made up of tris."""
-
-    def __init__(
-        self, position, cluster_verts, cluster_textures_ravelled, texture_id, cluster_normals_ravelled
-    ):
-        self.position = position
-        self.texture_id = texture_id
-        self.cluster_textures = cluster_textures_ravelled
-        self.cluster_normals = cluster_normals_ravelled
-
-        self.cluster_verts = [None]
-        position = np.array(position, dtype=np.float32)
-        for i in range(1, len(cluster_verts)):
-            self.cluster_verts.append((cluster_verts[i] + position).ravel())
-        
-        self.vertex_vbo = None
-        self.tex_vbo = None
-        self.norm_vbo = None
-        self.clusters = set([len(self.cluster_verts) - 1])
-
-    def set_clusters(self, cluster_ids):
-        self.clusters = cluster_ids
-        self.update_vbo()
-
-    def bind_buffers(self):
-        if self.vertex_vbo is None:
-            self.update_vbo()
-
-        self.vertex_vbo.bind()
+from .allocator import RangeAllocator
+
+FRAGMENTATION_THRESHOLD = 0.25  # Fraction of a buffer that is free, but not in the largest free range
+
+
+class ModelBuffers:
+    """Buffers with the clusters of a model on the GPU, shared by all its instances.
+
+    Clusters are placed in ranges of the buffers by RangeAllocators. Either all clusters are uploaded
+    at once (pinned), or clusters are uploaded while any instance draws them and their ranges are
+    freed afterwards. Buffers are compacted once fragmentation crosses FRAGMENTATION_THRESHOLD.
+    Indices are local to the cluster, a cluster is drawn with its first vertex as base vertex.
+    """
+
+    # Name, element size in bytes (vertex or index)
+    VERTEX_ATTRIBUTES = [("verts", 12), ("textures", 8), ("normals", 12)]
+    INDEX_SIZE = 4
+
+    def __init__(self, lod_dag, vertex_capacity=1 << 16, index_capacity=1 << 18):
+        self.lod_dag = lod_dag
+        self.vertex_counts = np.diff(lod_dag.vertex_offsets).astype(np.int64)
+        self.index_counts = np.diff(lod_dag.index_offsets).astype(np.int32)
+        self.vertex_starts = np.full(len(self.index_counts), -1, dtype=np.int64)  # -1: Not uploaded
+        self.index_starts = np.full(len(self.index_counts), -1, dtype=np.int64)
+        self.references = np.zeros(len(self.index_counts), dtype=np.int64)
+        self.pinned = False
+        self.uploaded_bytes = 0  # Total, for stats
+        self.generation = 0  # Incremented whenever uploaded clusters are moved
+
+        self.buffers = {}
+        self._reallocate(vertex_capacity, index_capacity)
+
+    def upload_all(self):
+        # All clusters at once, straight from the flat arrays of the baked model. They stay pinned.
+        if self.pinned:
+            return
+        self.vertex_starts[:] = self.index_starts[:] = -1  # Replaced, not copied
+        num_verts, num_indices = self.vertex_counts.sum(), self.index_counts.sum()
+        self._reallocate(num_verts, num_indices)
+        self.vertex_allocator.allocate(num_verts)
+        self.index_allocator.allocate(num_indices)
+        self.vertex_starts[:] = self.lod_dag.vertex_offsets[:-1]
+        self.index_starts[:] = self.lod_dag.index_offsets[:-1]
+
+        verts, normals, textures = self.lod_dag.cluster_attributes()
+        self._upload(0, {"verts": verts, "textures": textures, "normals": normals},
+                     0, self.lod_dag.baked_arrays["indices"])
+        self.pinned = True
+        self.generation += 1
+
+    def retain(self, clusters, cluster_geometry):
+        # Clusters drawn by an instance, missing ones are uploaded (cluster_geometry: see LODGraph)
+        for cluster in clusters:
+            self.references[cluster] += 1
+            if self.vertex_starts[cluster] < 0:
+                verts, indices, textures, normals = cluster_geometry(cluster)
+                vertex_start, index_start = self._allocate(cluster)
+                self._upload(vertex_start, {"verts": verts, "textures": textures, "normals": normals},
+                             index_start, indices)
+
+    def upload_bytes(self, clusters):
+        # Bytes retaining clusters would upload
+        missing = [cluster for cluster in clusters if self.vertex_starts[cluster] < 0]
+        vertex_size = sum(size for __, size in self.VERTEX_ATTRIBUTES)
+        return int(self.vertex_counts[missing].sum() * vertex_size + self.index_counts[missing].sum() * self.INDEX_SIZE)
+
+    def release(self, clusters):
+        # Clusters no longer drawn by an instance, unused ranges are freed
+        if self.pinned:
+            return
+        for cluster in clusters:
+            self.references[cluster] -= 1
+            if self.references[cluster] == 0:
+                self.vertex_allocator.free(self.vertex_starts[cluster], self.vertex_counts[cluster])
+                self.index_allocator.free(self.index_starts[cluster], self.index_counts[cluster])
+                self.vertex_starts[cluster] = self.index_starts[cluster] = -1
+
+        fragmentation = max(self.vertex_allocator.fragmentation(), self.index_allocator.fragmentation())
+        if fragmentation > FRAGMENTATION_THRESHOLD:
+            self.compact()
+
+    def compact(self):
+        self._reallocate(self.vertex_allocator.capacity, self.index_allocator.capacity)
+
+    def _allocate(self, cluster):
+        num_verts, num_indices = self.vertex_counts[cluster], self.index_counts[cluster]
+        vertex_start = self.vertex_allocator.allocate(num_verts)
+        index_start = self.index_allocator.allocate(num_indices)
+        if vertex_start is None or index_start is None:
+            if vertex_start is not None:
+                self.vertex_allocator.free(vertex_start, num_verts)
+            if index_start is not None:
+                self.index_allocator.free(index_start, num_indices)
+
+            # Grow if compaction does not free enough space
+            vertex_capacity, index_capacity = self.vertex_allocator.capacity, self.index_allocator.capacity
+            if self.vertex_allocator.used + num_verts > vertex_capacity:
+                vertex_capacity = max(2 * vertex_capacity, self.vertex_allocator.used + num_verts)
+            if self.index_allocator.used + num_indices > index_capacity:
+                index_capacity = max(2 * index_capacity, self.index_allocator.used + num_indices)
+            self._reallocate(vertex_capacity, index_capacity)
+            vertex_start = self.vertex_allocator.allocate(num_verts)
+            index_start = self.index_allocator.allocate(num_indices)
+
+        self.vertex_starts[cluster], self.index_starts[cluster] = vertex_start, index_start
+        return vertex_start, index_start
+
+    def _reallocate(self, vertex_capacity, index_capacity):
+        # New buffers, uploaded clusters are copied (on the GPU) to the front in their current order
+        uploaded = np.flatnonzero(self.vertex_starts >= 0)
+        buffers = {}
+        allocators = []
+        for starts, counts, names, capacity in [
+            (self.vertex_starts, self.vertex_counts, self.VERTEX_ATTRIBUTES, vertex_capacity),
+            (self.index_starts, self.index_counts, [("indices", self.INDEX_SIZE)], index_capacity),
+        ]:
+            order = uploaded[np.argsort(starts[uploaded])]
+            old_starts, sizes = starts[order], counts[order].astype(np.int64)
+            new_starts = np.cumsum(sizes) - sizes
+
+            # Ranges that are adjacent in the old buffers are copied at once
+            runs = np.flatnonzero(np.diff(old_starts) != sizes[:-1]) + 1
+            runs = np.concatenate([[0], runs]) if len(order) else runs
+            run_sizes = np.add.reduceat(sizes, runs) if len(order) else sizes
+
+            for name, size in names:
+                buffers[name] = glGenBuffers(1)
+                glBindBuffer(GL_ARRAY_BUFFER, buffers[name])
+                glBufferData(GL_ARRAY_BUFFER, int(max(capacity, 1) * size), None, GL_DYNAMIC_DRAW)
+                glBindBuffer(GL_ARRAY_BUFFER, 0)
+                if name not in self.buffers:
+                    continue
+
+                glBindBuffer(GL_COPY_READ_BUFFER, self.buffers[name])
+                glBindBuffer(GL_COPY_WRITE_BUFFER, buffers[name])
+                for old, new, count in zip(old_starts[runs], new_starts[runs], run_sizes):
+                    glCopyBufferSubData(
+                        GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, int(old * size), int(new * size), int(count * size)
+                    )
+                glBindBuffer(GL_COPY_READ_BUFFER, 0)
+                glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+                glDeleteBuffers(1, [self.buffers[name]])
+
+            starts[order] = new_starts
+            allocators.append(RangeAllocator(int(capacity)))
+            allocators[-1].allocate(int(sizes.sum()))
+
+        self.buffers = buffers
+        self.vertex_allocator, self.index_allocator = allocators
+        self.generation += 1
+
+    def _upload(self, first_vertex, attributes, first_index, indices):
+        uploads = [(name, attributes[name], np.float32, first_vertex * size) for name, size in self.VERTEX_ATTRIBUTES]
+        uploads.append(("indices", indices, np.uint32, first_index * self.INDEX_SIZE))
+        for name, data, dtype, offset in uploads:
+            data = np.ascontiguousarray(data, dtype=dtype)
+            glBindBuffer(GL_ARRAY_BUFFER, self.buffers[name])
+            glBufferSubData(GL_ARRAY_BUFFER, int(offset), data.nbytes, data)
+            self.uploaded_bytes += data.nbytes
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def bind(self):
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers["verts"])
         glEnableClientState(GL_VERTEX_ARRAY)
-        glVertexPointer(3, GL_FLOAT, 0, self.vertex_vbo)
+        glVertexPointer(3, GL_FLOAT, 0, None)
 
-        self.tex_vbo.bind()
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers["textures"])
         glEnableClientState(GL_TEXTURE_COORD_ARRAY)
-        glTexCoordPointer(2, GL_FLOAT, 0, self.tex_vbo)
+        glTexCoordPointer(2, GL_FLOAT, 0, None)
 
-        self.norm_vbo.bind()
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers["normals"])
         glEnableClientState(GL_NORMAL_ARRAY)
-        glNormalPointer(GL_FLOAT, 0, self.norm_vbo)
+        glNormalPointer(GL_FLOAT, 0, None)
 
-    def unbind_buffers(self):
-        glDisableClientState(GL_NORMAL_ARRAY)
-        self.norm_vbo.unbind()
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.buffers["indices"])
 
+    def unbind(self):
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        glDisableClientState(GL_NORMAL_ARRAY)
         glDisableClientState(GL_TEXTURE_COORD_ARRAY)
-        self.tex_vbo.unbind()
-
         glDisableClientState(GL_VERTEX_ARRAY)
-        self.vertex_vbo.unbind()
 
-    def draw(self):
-        glEnable(GL_TEXTURE_2D)
-        glBindTexture(GL_TEXTURE_2D, self.texture_id)
-        self.bind_buffers()
+    def shutdown(self):
+        glDeleteBuffers(len(self.buffers), list(self.buffers.values()))
+        self.buffers = {}
 
-        glDrawArrays(GL_TRIANGLES, 0, self.num_vertices)
 
-        self.unbind_buffers()
-        glDisable(GL_TEXTURE_2D)
+class ClusterMesh:
+    """Drawing a mesh with multiple clusters made up of indexed tris (local vertices per cluster).
 
-    def update_vbo(self):
-        # Call this function every time the clusters change
-        vertices = np.concatenate([self.cluster_verts[id] for id in self.clusters])
-        texcoords = np.concatenate([self.cluster_textures[id] for id in self.clusters])
-        normals = np.concatenate([self.cluster_normals[id] for id in self.clusters])
-        self.num_vertices = vertices.size
-
-        if self.vertex_vbo is None:
-            self.vertex_vbo = vbo.VBO(vertices)
-            self.tex_vbo = vbo.VBO(texcoords)
-            self.norm_vbo = vbo.VBO(normals)
-
-        else:
-            self.vertex_vbo.set_array(vertices)
-            self.vertex_vbo.bind()
-            self.vertex_vbo.copy_data()
-            self.vertex_vbo.unbind()
-
-            self.tex_vbo.set_array(texcoords)
-            self.tex_vbo.bind()
-            self.tex_vbo.copy_data()
-            self.tex_vbo.unbind()
-
-            self.norm_vbo.set_array(normals)
-            self.norm_vbo.bind()
-            self.norm_vbo.copy_data()
-            self.norm_vbo.unbind()
+    The geometry is in the shared ModelBuffers of the model, the ranges of the clusters are looked
+    up when drawing and kept until the buffers are compacted or grown. The transform of the instance
+    is applied when drawing.
+    """
 
-    def shutdown(self):
-        self.vertex_vbo.delete()
-        self.tex_vbo.delete()
-        self.norm_vbo.delete()
\ No newline at end of file
+    def __init__(self, buffers, texture_id, root_cluster):
+        self.buffers = buffers
+        self.texture_id = texture_id
+        self.set_clusters(set([root_cluster]))
+
+    def prepare(self, cluster_array):
+        # Arrays to draw the clusters (ids, index counts), see set_clusters. No OpenGL calls and the
+        # index counts never change: Can be called on any thread.
+        return cluster_array, self.buffers.index_counts[cluster_array]
+
+    def set_clusters(self, cluster_ids, prepared=None):
+        # The clusters must be retained in the buffers, prepared: Optional result of prepare
+        if prepared is None:
+            prepared = self.prepare(np.fromiter(cluster_ids, dtype=np.int64, count=len(cluster_ids)))
+        self.clusters = cluster_ids
+        self.cluster_array, self.counts = prepared
+        self.num_indices = int(self.counts.sum())
+        self.ranges = None  # Generation of the buffers, first index offsets and base vertices
+
+    def draw(self):
+        glEnable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, self.texture_id)
+        self.buffers.bind()
+
+        if self.ranges is None or self.ranges[0] != self.buffers.generation:
+            self.ranges = (
+                self.buffers.generation,
+                (self.buffers.index_starts[self.cluster_array] * self.buffers.INDEX_SIZE).astype(np.uintp),
+                self.buffers.vertex_starts[self.cluster_array].astype(np.int32),
+            )
+        __, firsts, base_vertices = self.ranges
+        glMultiDrawElementsBaseVertex(
+            GL_TRIANGLES, self.counts, GL_UNSIGNED_INT, firsts, len(self.counts), base_vertices
+        )
+
+        self.buffers.unbind()
+        glDisable(GL_TEXTURE_2D)
@@ -0,0 +1,228 @@
+import threading
+
+import numpy as np
+
+from .lod_mesh import THRESHOLD
+from .scene import SceneGrid
+
+
+class CutSelector:
+    """Selects the cuts of all meshes at once, independent of the previous frame.
+
+    Screen space errors of all instances and cluster groups of a model are evaluated in one pass.
+    A cluster is drawn if its group is too coarse and the group of its children is detailed enough
+    (see build_cut_groups). Errors and spheres of the groups are monotonic: The cut is always valid.
+    Instances and clusters of the cut outside the view frustum are not drawn.
+    scheduler: Optional LODUpdateScheduler, otherwise all changed cuts are applied at once.
+    max_distance: Instances further away are not drawn (only with a SceneGrid).
+    """
+
+    def __init__(self, camera, threshold=THRESHOLD, scheduler=None, max_distance=None):
+        self.camera = camera
+        self.threshold = threshold
+        self.scheduler = scheduler
+        self.max_distance = max_distance
+        self.visible_meshes = []  # Meshes to draw (SceneGrid)
+
+    def update(self, meshes):
+        # Set the cut of every mesh
+        self.apply(self.select_cuts(self.camera, meshes))
+
+    def apply(self, cuts):
+        # Render thread, cuts can be None (nothing new, scheduled cuts are still applied)
+        if self.scheduler is None:
+            apply_cuts(cuts or [])
+        else:
+            self.scheduler.submit(cuts or [])
+            self.scheduler.update()
+
+    def select_cuts(self, camera, meshes):
+        # List of (mesh, clusters, priority, prepared), meshes of the same model are evaluated together.
+        # prepared: Arrays to draw the clusters (see ClusterMesh.prepare) or None, swapped in with the cut.
+        # meshes: List or SceneGrid. Of a SceneGrid only visible meshes are evaluated, the others get an
+        # empty cut once: Sets visible_meshes and takes the meshes inserted into the scene since.
+        # No OpenGL calls, the meshes are not changed (cuts are applied by update)
+        cuts = []
+        if isinstance(meshes, SceneGrid):
+            visible = meshes.query(camera, self.max_distance)
+            # Meshes that are no longer (or were never) visible: Empty cut, once
+            hidden = (set(self.visible_meshes) | set(meshes.take_inserted())).difference(visible)
+            cuts.extend((mesh, set(), 1.0, None) for mesh in hidden)
+            self.visible_meshes = meshes = visible
+
+        meshes_by_graph = {}
+        for mesh in meshes:
+            meshes_by_graph.setdefault(mesh.lod_dag, []).append(mesh)
+
+        for graph, graph_meshes in meshes_by_graph.items():
+            group_of, child_group = graph.cut_groups[:2]
+            positions = np.array([mesh.position for mesh in graph_meshes], dtype=np.float64)
+            # Sets of clusters are replaced, not changed: Safe to read from another thread
+            currents = [list(mesh.cluster_mesh.clusters) for mesh in graph_meshes]
+            # Priorities of cuts that change need the errors of all groups (far instances: root only)
+            exact = [current != [len(group_of) - 1] for current in currents]
+            values, draw = self._select(graph, positions, camera, exact)
+            for mesh, current, instance_values, instance_draw in zip(graph_meshes, currents, values, draw):
+                priority = self.cut_priority(instance_values, group_of[current], child_group[current])
+                cluster_array = np.flatnonzero(instance_draw)
+                prepared = mesh.cluster_mesh.prepare(cluster_array)
+                cuts.append((mesh, set(cluster_array.tolist()), priority, prepared))
+        return cuts
+
+    def select(self, graph, positions, camera=None):
+        # Clusters to draw for instances of a graph at positions (N x 3), boolean (N x clusters)
+        return self._select(graph, positions, camera or self.camera)[1]
+
+    def _select(self, graph, positions, camera, exact=None):
+        # Screen space errors of the groups (N x groups + 1, LOD 0 children last) and clusters to draw
+        # exact: Optional boolean per instance, errors of all groups are needed (priority of a new cut)
+        group_of, child_group, group_errors, centers, radii = graph.cut_groups
+        root = group_of[-1]
+        values = np.zeros((len(positions), len(group_errors) + 1))
+        values[:, -1] = -np.inf  # LOD 0 (no children): Always detailed enough
+        draw = np.zeros((len(positions), len(group_of)), dtype=bool)
+
+        # Instances outside the frustum (root group sphere contains all clusters): Nothing to draw
+        visible = np.flatnonzero(camera.check_spheres_in_frustum(centers[root] + positions, radii[root]))
+        if len(visible) == 0:
+            return values, draw
+        positions = positions[visible]
+        visible_values = values[visible]
+        visible_values[:, root] = np.inf  # Root: Never coarser
+        visible_draw = np.zeros((len(visible), len(group_of)), dtype=bool)
+
+        # Far instances (children of the root are detailed enough): Root only, no per group work.
+        # Unless exact, groups below the root get the value of the children of the root (the largest).
+        root_children = child_group[-1]
+        near = np.ones(len(visible), dtype=bool)
+        if root_children >= 0:
+            dists = np.linalg.norm(centers[root_children] + positions - camera.position, axis=1)
+            dists -= radii[root_children]
+            with np.errstate(divide="ignore"):
+                root_children_values = np.where(dists > 0, group_errors[root_children] / dists, np.inf)
+            near = root_children_values > self.threshold
+            visible_values[~near, :-1] = root_children_values[~near, None]
+            visible_values[~near, root] = np.inf
+        visible_draw[~near, -1] = True
+
+        evaluated = near if exact is None else near | np.asarray(exact, dtype=bool)[visible]
+        if evaluated.any():
+            evaluated_values = self.group_screen_space_errors(
+                group_errors, centers + positions[evaluated, None], radii, camera
+            )
+            evaluated_values[:, root] = np.inf
+            visible_values[evaluated, :-1] = evaluated_values
+            visible_draw[near] = (
+                (visible_values[near][:, child_group] <= self.threshold)
+                & (visible_values[near][:, group_of] > self.threshold)
+            )
+
+        # Clusters of the cut outside the frustum are not drawn
+        instances, clusters = np.nonzero(visible_draw)
+        outside = ~camera.check_spheres_in_frustum(
+            graph.cluster_bounding_centers[clusters] + positions[instances],
+            graph.cluster_bounding_radii[clusters],
+        )
+        visible_draw[instances[outside], clusters[outside]] = False
+
+        values[visible] = visible_values
+        draw[visible] = visible_draw
+        return values, draw
+
+    def cut_priority(self, values, groups, child_groups):
+        # How far the current cut (groups of its clusters) is from the threshold: Missing detail first
+        # (> 1, near and visible instances have larger errors), then unnecessary detail (0 - 1)
+        if len(groups) == 0:
+            return np.inf  # Nothing drawn
+        refine = values[child_groups].max() / self.threshold
+        if refine > 1:
+            return 1 + np.log(refine)
+        coarsen = self.threshold / max(values[groups].min(), 1e-30)
+        return min(np.log(coarsen), 10) / 10 if coarsen >= 1 else 0.0
+
+    def group_screen_space_errors(self, errors, centers, radii, camera):
+        dists = np.linalg.norm(centers - camera.position, axis=-1) - radii
+        with np.errstate(divide="ignore"):
+            result = errors / dists
+
+        # Culling (spheres: Monotonic, a group is only culled if all its children are)
+        result[~camera.check_spheres_in_frustum(centers, radii)] = 0
+
+        # We are inside the bounding sphere
+        result[dists <= 0] = np.inf
+
+        return result
+
+    def shutdown(self):
+        pass
+
+
+class AsyncCutSelector(CutSelector):
+    """A CutSelector on a worker thread, driven by camera snapshots.
+
+    Double buffered: update (render thread) hands the latest request to the worker and swaps in the
+    cuts it finished since, together with their prepared draw arrays. Only the render thread sets
+    clusters (OpenGL calls: uploads and residency), the worker keeps selecting for the most recent
+    request and skips older ones. Cuts lag behind by about a frame.
+    """
+
+    def __init__(self, camera, threshold=THRESHOLD, scheduler=None, max_distance=None):
+        super().__init__(camera, threshold, scheduler, max_distance)
+        self.condition = threading.Condition()
+        self.request = None  # (camera snapshot, meshes or SceneGrid)
+        self.finished = None  # Cuts of the latest finished request
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def update(self, meshes):
+        with self.condition:
+            finished, self.finished = self.finished, None
+            self.request = (self.camera.snapshot(), meshes if isinstance(meshes, SceneGrid) else list(meshes))
+            self.condition.notify()
+
+        self.apply(finished)
+
+    def wait(self):
+        # Block until the latest request is finished (tests, screenshots)
+        with self.condition:
+            self.condition.wait_for(lambda: self.request is None and self.finished is not None)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.request is not None or not self.running)
+                if not self.running:
+                    return
+                request = self.request
+
+            cuts = self.select_cuts(*request)
+
+            with self.condition:
+                # Done, unless a newer request came in meanwhile (these cuts are still newer than the drawn ones)
+                if self.request is request:
+                    self.request = None
+                # Cuts that were not swapped in yet are kept, unless replaced (hidden meshes: only once)
+                if self.finished is not None:
+                    newer = {cut[0] for cut in cuts}
+                    cuts = [cut for cut in self.finished if cut[0] not in newer] + cuts
+                self.finished = cuts
+                self.condition.notify_all()
+
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+
+def apply_cuts(cuts):
+    # Render thread: Set the clusters of meshes whose cut changed (see CutSelector.select_cuts)
+    for mesh, clusters, __, prepared in cuts:
+        if clusters == mesh.cluster_mesh.clusters:
+            continue
+        # Clusters that are still loading are not switched to yet (the current ones are kept)
+        if mesh.is_resident(clusters):
+            mesh.set_clusters(clusters, prepared)
+        else:
+            mesh.show_root_if_culled()
@@ -1,26 +1,37 @@
-from collections import defaultdict
-from functools import partial
+import hashlib
+import json
 import multiprocessing as mp
-import pickle
+import os
+import shutil
+import sys
+import zipfile
+from functools import cached_property
+from time import time
 
 from scipy.spatial import KDTree
 import numpy as np
 
+from .baked_model import (
+    dequantize_attributes, quantize_attributes, read_baked_model, write_baked_model
+)
 from .utils import (
-    calc_bounding_sphere,
-    calc_RMS_error,
-    create_dual_graph,
+    RMSErrorIndex,
+    create_dual_graph_csr,
     group_tris,
     group_clusters,
+    group_members,
     load_obj,
-    load_texture,
-    minimum_bounding_sphere,
+    morton_codes,
     simplify_mesh_inside,
+    transfer_texture_coords,
 )
 
 
 class LODGraph:
-    def __init__(self, paths, force_build=False, cluster_size_initial=160, cluster_size=128, group_size=8):
+    def __init__(self, paths, force_build=False, cluster_size_initial=160, cluster_size=128, group_size=8,
+                 num_workers=1, cache=None, quantize_error=None):
+        # cache: Optional BakeCache, rebakes whenever the source files or the config change
+        # quantize_error: Store quantized clusters (max position error per axis), None for float32
         obj_path, texture_path, build_path = paths
 
         self.config = {
@@ -29,259 +40,615 @@ class LODGraph:
             "group_size": group_size
         }
 
-        if not force_build:
-            if self.load_from_pickle(build_path):
+        if cache is not None:
+            bake_config = dict(self.config, quantize_error=quantize_error)
+            cache_key = cache.key([obj_path, texture_path], bake_config)
+            cached_path = cache.get(cache_key)
+            if not force_build and cached_path is not None:
+                if self.load_baked(cached_path, texture_path):
+                    return
+        elif not force_build:
+            if self.load_baked(build_path, texture_path):
                 return
-            
+
         print(f"Baking new LOD graph ({obj_path}). This will take a while...")
 
-        # Create LOD 0
         vertices, tris, texture_coords, orig_normals = load_obj(obj_path)
-        adjacencies, clusters = group_tris(tris, self.config["cluster_size_initial"])
-        assert len(clusters) == len(tris)
-
-        graph_adjacencies = [np.array(range(max(clusters) + 1))]
-        geometric_errors = [0]
-        self.lods = [
-            [
-                vertices,
-                tris,
-                adjacencies,
-                clusters,
-                graph_adjacencies,
-                geometric_errors,
-                orig_normals.copy(),
+
+        # Every finished lod is checkpointed, an interrupted bake resumes from the last one
+        checkpoint_dir = build_path + ".checkpoint"
+        stat = os.stat(obj_path)
+        checkpoint_key = {"obj": [stat.st_size, stat.st_mtime_ns], "config": self.config}
+        self.lods = load_checkpoint(checkpoint_dir, checkpoint_key)
+
+        if self.lods:
+            print(f"Resuming bake from checkpoint at LOD {len(self.lods) - 1}.")
+        else:
+            # Create LOD 0
+            adjacencies, clusters = group_tris(tris, self.config["cluster_size_initial"])
+            assert len(clusters) == len(tris)
+
+            graph_adjacencies = [np.arange(clusters.max() + 1)]
+            geometric_errors = [0]
+            self.lods = [
+                [
+                    vertices,
+                    tris,
+                    adjacencies,
+                    clusters,
+                    graph_adjacencies,
+                    geometric_errors,
+                    orig_normals.copy(),
+                ]
             ]
-        ]
+            save_checkpoint(checkpoint_dir, checkpoint_key, 0, self.lods[0])
 
-        clusters_remaining = max(clusters) + 1
+        clusters_remaining = self.lods[-1][3].max() + 1
         print(
-            f"LOD 0 has {len(self.lods[-1][1])} tris and {clusters_remaining} clusters."
+            f"LOD {len(self.lods) - 1} has {len(self.lods[-1][1])} tris and {clusters_remaining} clusters."
         )
 
         # Simplify the graph until we have a single cluster remaining
         while clusters_remaining > 1:
-            self.lods.append(next_lod(self.lods[-1], self.config))
-            clusters_remaining = max(self.lods[-1][3]) + 1
+            self.lods.append(next_lod(self.lods[-1], self.config, num_workers))
+            previous_clusters, clusters_remaining = clusters_remaining, self.lods[-1][3].max() + 1
             print(
                 f"LOD {len(self.lods) - 1} has {len(self.lods[-1][1])} tris and {clusters_remaining} clusters."
             )
+            # Preserved borders (open meshes) or fans can stop the simplification
+            if clusters_remaining >= previous_clusters:
+                raise RuntimeError(
+                    f"LOD generation stalled at {clusters_remaining} clusters ({obj_path})"
+                )
+            save_checkpoint(checkpoint_dir, checkpoint_key, len(self.lods) - 1, self.lods[-1])
 
         # Create the cluster DAG
-        cluster_dag = []
-        cluster_errors = []
-        cluster_verts = [[]]
-        cluster_normals = [[]]
-        cluster_tris = [[]]
-        num_clusters = 1  # ! Attention, this is dependent on having a single sink node
-        for lod in self.lods:
-            vertices, tris, __, clusters, graph_adjacencies, geometric, normals = lod
-
-            for adjs in graph_adjacencies:
-                cluster_dag.append(adjs + num_clusters)
-
-            cluster_errors += geometric
-            cluster_tris.append(tris)
-
-            # Collect all vertices for tris
-            cluster_map = defaultdict(list)
-            for i, cluster in enumerate(clusters):
-                cluster_map[cluster].append(tris[i])
-
-            for i in range(max(clusters) + 1):
-                verts = vertices[cluster_map[i]].reshape(-1, 3)
-                cluster_verts.append(verts)
-                norms = normals[cluster_map[i]].reshape(-1, 3)
-                cluster_normals.append(norms)
-
-            num_current_clusters = max(clusters) + 1
-            num_clusters += num_current_clusters
-
-        cluster_dag.append([])  # Root node (least detailed)
-        cluster_errors.append(1.5 * cluster_errors[-1])
-
-        cluster_dag = [[int(i) for i in j] for j in cluster_dag]
-
-        # Create the reverse DAG (lookup from child to parent)
-        cluster_dag_rev = defaultdict(list)
-        for i, adjs in enumerate(cluster_dag):
-            for adj in adjs:
-                cluster_dag_rev[adj].append(i)
-        
-        cluster_dag_rev = [cluster_dag_rev[i] for i in range(num_clusters)]
-
-        # Enforce monotonic cluster error and monotonic increasing bounding spheres (parent fully contains children)
-        cluster_bounding_spheres = [((0, 0, 0), 0)]
-        monotonic_error = [0]
-        for i in range(1, num_clusters):
-            sphere = calc_bounding_sphere(cluster_verts[i])
-            error = cluster_errors[i]
-            children = cluster_dag_rev[i]
-            if children:
-                if min(children) != 0:
-                    all_spheres = [sphere] + [cluster_bounding_spheres[j] for j in children]
-                    sphere = minimum_bounding_sphere(all_spheres)
-
-                    kid_error = max([monotonic_error[j] for j in children])
-                    if error <= kid_error:
-                        error = kid_error * 1.001 # Cheat using an epsilon
-
-            cluster_bounding_spheres.append(sphere)
-            monotonic_error.append(error)
-        
-        # Check whether error is strictly monotonous and bounding spheres are strictly increasing in radius
-        # for i in range(1, num_clusters):
-        #     for j in cluster_dag_rev[i]:
-        #         assert monotonic_error[i] > monotonic_error[j]
-        #         assert cluster_bounding_spheres[i][1] >= cluster_bounding_spheres[j][1]
-
-        self.texture_id = load_texture(texture_path)
-        cluster_textures = [[]]
-        tree = KDTree(self.lods[0][0])
-
-        # Texturing: Interpolate btw n closest vertices
-        num_neighbors = 2
-        for i in range(1, num_clusters):
-            verts = cluster_verts[i]
-            dists, indices = tree.query(verts, num_neighbors)
-            tex_coords = texture_coords[indices]
-
-            weights = 1 / (dists + 1e-8)  # Add a small epsilon to avoid division by zero
-            weights /= np.sum(weights, axis=1, keepdims=True)
-            cluster_textures.append(np.einsum('ij,ijk->ik', weights, tex_coords)) # Magic einsum
-
-        self.cluster_dag = cluster_dag
-        self.cluster_dag_rev = cluster_dag_rev
-        self.cluster_verts = cluster_verts
-        self.cluster_errors = np.array(monotonic_error)
-        self.cluster_bounding_centers = np.array(
-            [i[0] for i in cluster_bounding_spheres]
-        )
-        self.cluster_bounding_radii = np.array([i[1] for i in cluster_bounding_spheres])
-        self.cluster_normals = cluster_normals
-        self.cluster_textures = cluster_textures
+        (
+            cluster_dag,
+            cluster_dag_rev,
+            cluster_verts,
+            cluster_indices,
+            cluster_normals,
+            cluster_errors,
+            cluster_bounding_centers,
+            cluster_bounding_radii,
+        ) = build_cluster_dag(self.lods)
+        num_clusters = len(cluster_dag)
+
+        # Texturing: Interpolate btw n closest vertices of LOD 0 (all clusters in a single query)
+        start_time = time()
+        tree = lod0_tree(self.lods[0][0])
+        lengths = [len(verts) for verts in cluster_verts[1:]]
+        tex_coords = transfer_texture_coords(tree, texture_coords, np.concatenate(cluster_verts[1:]))
+        cluster_textures = [np.zeros((0, 2))] + np.split(tex_coords, np.cumsum(lengths)[:-1])
+        print(f"Texturing took {time() - start_time:.2f}s")
 
         assert (
-            len(self.cluster_dag)
-            == len(self.cluster_dag_rev)
+            len(cluster_dag)
+            == len(cluster_dag_rev)
             == num_clusters
-            == len(self.cluster_verts)
-            == len(self.cluster_errors)
-            == len(self.cluster_bounding_centers)
-            == len(self.cluster_bounding_radii)
-            == len(self.cluster_normals)
-            == len(self.cluster_textures)
+            == len(cluster_verts)
+            == len(cluster_indices)
+            == len(cluster_errors)
+            == len(cluster_bounding_centers)
+            == len(cluster_bounding_radii)
+            == len(cluster_normals)
+            == len(cluster_textures)
         )
-        self._post_process()
-        self.save_to_pickle(paths)
-        print(f"Baked cluster mesh with {len(cluster_dag)} clusters.")
-
-    def _post_process(self):
-        # A bit hacky...
-        self.cluster_verts = [np.array(i, dtype=np.float32) for i in self.cluster_verts]
-        self.cluster_normals = [np.array(i, dtype=np.float32).ravel() for i in self.cluster_normals]
-        self.cluster_textures = [np.array(i, dtype=np.float32).ravel() for i in self.cluster_textures]
-
-    def save_to_pickle(self, paths):
-        data = [
-            self.cluster_dag,
-            self.cluster_dag_rev,
-            self.cluster_verts,
-            self.cluster_errors,
-            self.cluster_bounding_centers,
-            self.cluster_bounding_radii,
-            self.cluster_normals,
-            self.cluster_textures,
-            paths,
-        ]
-        with open(paths[2], "wb") as f:
-            pickle.dump(data, f)
-
-    def load_from_pickle(self, path):
+
+        # Store flat arrays with offset tables, all clusters are views into those when loaded
+        vertex_offsets = np.zeros(num_clusters + 1, dtype=np.int32)
+        np.cumsum([len(verts) for verts in cluster_verts], out=vertex_offsets[1:])
+        index_offsets = np.zeros(num_clusters + 1, dtype=np.int32)
+        np.cumsum([len(indices) for indices in cluster_indices], out=index_offsets[1:])
+        # Local indices: 8 bits are enough for most clusters
+        max_cluster_verts = np.diff(vertex_offsets).max()
+        index_type = np.uint32
+        if max_cluster_verts <= 2**16:
+            index_type = np.uint8 if max_cluster_verts <= 2**8 else np.uint16
+        dag_offsets = np.zeros(num_clusters + 1, dtype=np.int32)
+        np.cumsum([len(parents) for parents in cluster_dag], out=dag_offsets[1:])
+        rev_offsets = np.zeros(num_clusters + 1, dtype=np.int32)
+        np.cumsum([len(children) for children in cluster_dag_rev], out=rev_offsets[1:])
+
+        attributes = {
+            "verts": np.concatenate(cluster_verts).astype(np.float32),
+            "normals": np.concatenate(cluster_normals).astype(np.float32),
+            "textures": np.concatenate(cluster_textures).astype(np.float32),
+        }
+        quantization = None
+        if quantize_error is not None:
+            quantized = quantize_attributes(
+                vertex_offsets, *attributes.values(), cluster_bounding_centers, cluster_bounding_radii,
+                quantize_error
+            )
+            if quantized is None:
+                print(f"Clusters too large to quantize with error {quantize_error}, storing float32.")
+            else:
+                attributes, quantization = quantized
+
+        write_baked_model(
+            build_path,
+            {
+                "vertex_offsets": vertex_offsets,
+                **attributes,
+                "index_offsets": index_offsets,
+                "indices": np.concatenate(cluster_indices).astype(index_type),
+                "dag_offsets": dag_offsets,
+                "dag": np.concatenate(cluster_dag).astype(np.int32),
+                "dag_rev_offsets": rev_offsets,
+                "dag_rev": np.concatenate(cluster_dag_rev).astype(np.int32),
+                "errors": cluster_errors,
+                "bounding_centers": cluster_bounding_centers,
+                "bounding_radii": cluster_bounding_radii,
+            },
+            {"paths": paths, "quantization": quantization},
+        )
+        if cache is not None:
+            cache.put(cache_key, build_path)
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+        self.load_baked(build_path, texture_path)
+        print(f"Baked cluster mesh with {num_clusters} clusters.")
+
+    def load_baked(self, path, texture_path=None):
+        # Memory map a baked model, per cluster arrays are views (nothing is read before it is used)
         try:
-            with open(path, "rb") as f:
-                print("Loading baked model from file.")
-                data = pickle.load(f)
+            arrays, meta = read_baked_model(path)
         except FileNotFoundError:
             return False
+        except ValueError as e:
+            print(f"{e}, rebaking.")
+            return False
+        print("Loading baked model from file.")
 
-        (
-            self.cluster_dag,
-            self.cluster_dag_rev,
-            self.cluster_verts,
+        def split(name, offsets):
+            return np.split(arrays[name], offsets[1:-1])
+
+        self.baked_arrays = arrays
+        self.quantization = meta.get("quantization")
+        self.vertex_offsets = arrays["vertex_offsets"]
+        self.index_offsets = arrays["index_offsets"]
+        self.cluster_dag = split("dag", arrays["dag_offsets"])
+        self.cluster_dag_rev = split("dag_rev", arrays["dag_rev_offsets"])
+        self.cluster_errors = arrays["errors"]
+        self.cluster_bounding_centers = arrays["bounding_centers"]
+        self.cluster_bounding_radii = arrays["bounding_radii"]
+
+        self.texture_path = texture_path or meta["paths"][1]
+
+        print(f"Loaded cluster mesh with {len(self.cluster_dag)} clusters.")
+
+        return True
+
+    @cached_property
+    def texture_id(self):
+        # Uploaded on first use, requires an OpenGL context (baking and loading don't)
+        from .texture import load_texture
+        return load_texture(self.texture_path)
+
+    @cached_property
+    def gpu_buffers(self):
+        # Shared by all instances, created on first use (requires an OpenGL context)
+        from .cluster_mesh import ModelBuffers
+        return ModelBuffers(self)
+
+    def shutdown(self):
+        # Delete the GPU buffers (if they were created)
+        if "gpu_buffers" in self.__dict__:
+            self.gpu_buffers.shutdown()
+            del self.gpu_buffers
+
+    def cluster_attributes(self, start=0, end=None):
+        # Vertex attributes (verts, normals, textures) of the clusters start:end, decoded if quantized
+        end = len(self.cluster_dag) if end is None else end
+        vertex_offsets = self.vertex_offsets[start:end + 1]
+        first, last = vertex_offsets[0], vertex_offsets[-1]
+        arrays = {name: self.baked_arrays[name][first:last] for name in ["verts", "normals", "textures"]}
+        if self.quantization is None:
+            return arrays["verts"], arrays["normals"], arrays["textures"]
+
+        return dequantize_attributes(
+            vertex_offsets - first,
+            arrays,
+            self.cluster_bounding_centers[start:end],
+            self.cluster_bounding_radii[start:end],
+            self.quantization,
+        )
+
+    # Per cluster arrays of all clusters, views into the baked model (or decoded all at once)
+    @cached_property
+    def _attributes(self):
+        return self.cluster_attributes()
+
+    @cached_property
+    def cluster_verts(self):
+        return np.split(self._attributes[0], self.vertex_offsets[1:-1])
+
+    @cached_property
+    def cluster_normals(self):
+        return np.split(self._attributes[1].reshape(-1), self.vertex_offsets[1:-1] * 3)
+
+    @cached_property
+    def cluster_textures(self):
+        return np.split(self._attributes[2].reshape(-1), self.vertex_offsets[1:-1] * 2)
+
+    @cached_property
+    def cluster_indices(self):
+        return np.split(self.baked_arrays["indices"], self.index_offsets[1:-1])
+
+    @cached_property
+    def cut_groups(self):
+        # See build_cut_groups
+        return build_cut_groups(
+            self.baked_arrays["dag_offsets"],
+            self.baked_arrays["dag"],
+            self.baked_arrays["dag_rev_offsets"],
+            self.baked_arrays["dag_rev"],
             self.cluster_errors,
             self.cluster_bounding_centers,
             self.cluster_bounding_radii,
-            self.cluster_normals,
-            self.cluster_textures,
-            paths,
-        ) = data
+        )
 
-        self.texture_id = load_texture(paths[1])
+    def cluster_geometry(self, cluster):
+        # Vertices, local indices, ravelled texture coords and normals of a cluster
+        return (
+            self.cluster_verts[cluster],
+            self.cluster_indices[cluster],
+            self.cluster_textures[cluster],
+            self.cluster_normals[cluster],
+        )
 
-        self._post_process()
+    def load_cluster(self, cluster):
+        # Like cluster_geometry, but reads a copy of a single cluster (see ResidencyManager)
+        verts, normals, textures = self.cluster_attributes(cluster, cluster + 1)
+        start, end = self.index_offsets[cluster:cluster + 2]
+        return (
+            np.array(verts),
+            np.array(self.baked_arrays["indices"][start:end]),
+            np.array(textures).reshape(-1),
+            np.array(normals).reshape(-1),
+        )
 
-        print(f"Loaded cluster mesh with {len(self.cluster_dag)} clusters.")
 
-        return True
+def save_checkpoint(directory, key, level, lod):
+    # Store a finished lod as <directory>/lod_<level>.npz, key identifies the bake (input and config)
+    # Files are written to a temporary path first, a checkpoint only appears once it is complete
+    os.makedirs(directory, exist_ok=True)
+    key_path = os.path.join(directory, "key.json")
+    if level == 0:
+        # A new bake: Remove stale lods of an older bake and record the key
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        with open(key_path + ".tmp", "w") as f:
+            json.dump(key, f)
+        os.replace(key_path + ".tmp", key_path)
+
+    vertices, tris, (xadj, adjncy), clusters, graph_adjacencies, geometric_errors, normals = lod
+    lod_path = os.path.join(directory, "lod_%03d.npz" % level)
+    with open(lod_path + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            vertices=vertices,
+            tris=tris,
+            xadj=xadj,
+            adjncy=adjncy,
+            clusters=clusters,
+            graph_adjacencies=np.concatenate(graph_adjacencies),
+            graph_adjacency_lengths=[len(adjs) for adjs in graph_adjacencies],
+            geometric_errors=geometric_errors,
+            normals=normals,
+        )
+    os.replace(lod_path + ".tmp", lod_path)
 
 
-def next_lod(lod, config, parallel=False):
+def load_checkpoint(directory, key):
+    # Load the lods of an interrupted bake, returns [] if there is no checkpoint for this key
+    try:
+        with open(os.path.join(directory, "key.json")) as f:
+            if json.load(f) != key:
+                return []
+    except (OSError, ValueError):
+        return []
+
+    lods = []
+    while True:
+        lod_path = os.path.join(directory, "lod_%03d.npz" % len(lods))
+        try:
+            with np.load(lod_path) as data:
+                lengths = data["graph_adjacency_lengths"]
+                lods.append(
+                    [
+                        data["vertices"],
+                        data["tris"],
+                        (data["xadj"], data["adjncy"]),
+                        data["clusters"],
+                        np.split(data["graph_adjacencies"], np.cumsum(lengths)[:-1]),
+                        list(data["geometric_errors"]),
+                        data["normals"],
+                    ]
+                )
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            return lods
+
+
+# KDTrees over LOD 0 vertices, shared by models with the same geometry
+# Only the most recently used ones are kept (least recently used first)
+LOD0_TREE_CACHE_SIZE = 4
+_lod0_trees = {}
+
+
+def lod0_tree(vertices):
+    key = hashlib.sha1(np.ascontiguousarray(vertices).tobytes()).hexdigest()
+    tree = _lod0_trees.pop(key, None)
+    if tree is None:
+        tree = KDTree(vertices)
+    _lod0_trees[key] = tree
+    while len(_lod0_trees) > LOD0_TREE_CACHE_SIZE:
+        del _lod0_trees[next(iter(_lod0_trees))]
+    return tree
+
+
+def build_cluster_dag(lods):
+    # Flatten all lods into a single cluster DAG (global cluster ids, ordered by lod)
+    # Cluster 0 is a virtual node below all LOD 0 clusters, the last cluster is the root
+    lod_sizes = [lod[3].max() + 1 for lod in lods]
+    lod_starts = np.cumsum([1] + lod_sizes)
+    num_clusters = lod_starts[-1]  # ! Attention, this is dependent on having a single sink node
+
+    # DAG (lookup from child to parents) in CSR form
+    parents = []
+    for lod, start in zip(lods, lod_starts):
+        parents += [adjs + start for adjs in lod[4]]
+    parents.append(np.zeros(0, dtype=int))
+
+    dag_offsets = np.zeros(num_clusters + 1, dtype=np.int64)
+    np.cumsum([len(adjs) for adjs in parents], out=dag_offsets[1:])
+    dag_ids = np.concatenate(parents).astype(np.int64)
+
+    # Reverse DAG (lookup from parent to children) in CSR form
+    rev_offsets, rev_order = group_members(dag_ids)
+    assert len(rev_offsets) == num_clusters + 1
+    rev_ids = np.repeat(np.arange(num_clusters), np.diff(dag_offsets))[rev_order]
+
+    cluster_errors = np.concatenate([lod[5] for lod in lods]).astype(np.float64)
+    cluster_errors = np.append(cluster_errors, 1.5 * cluster_errors[-1])
+
+    # Collect the tris grouped by cluster: Each cluster has its own vertices and a local index buffer
+    # Tris are ordered along a Morton curve, vertices by first use (post-transform cache locality)
+    verts = []
+    normals = []
+    indices = []
+    corner_counts = [[0]]
+    vertex_counts = [[0]]
+    bounding_verts = []
+    for vertices, tris, __, clusters, __, __, lod_normals in lods:
+        centroids = vertices[tris].mean(axis=1)
+        cluster_tris = np.lexsort((morton_codes(centroids), clusters))
+        corners = tris[cluster_tris].ravel()
+        corner_clusters = np.repeat(clusters[cluster_tris], 3)
+
+        # Unique (cluster, vertex) pairs in order of first use
+        __, first_index, inverse = np.unique(
+            corner_clusters * len(vertices) + corners, return_index=True, return_inverse=True
+        )
+        order = np.argsort(first_index)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        used = corners[first_index[order]]
+
+        num_lod_clusters = clusters.max() + 1
+        lod_vertex_counts = np.bincount(corner_clusters[first_index], minlength=num_lod_clusters)
+        vertex_starts = np.cumsum(lod_vertex_counts) - lod_vertex_counts
+        indices.append(rank[inverse.reshape(-1)] - np.repeat(vertex_starts[clusters[cluster_tris]], 3))
+
+        verts.append(vertices[used])
+        normals.append(lod_normals[used])
+        bounding_verts.append(vertices[corners])
+        corner_counts.append(np.bincount(clusters, minlength=num_lod_clusters) * 3)
+        vertex_counts.append(lod_vertex_counts)
+
+    verts = np.concatenate(verts).astype(np.float32)
+    normals = np.concatenate(normals)
+    indices = np.concatenate(indices)
+    corner_counts = np.concatenate(corner_counts)
+    vertex_offsets = np.cumsum(np.concatenate(vertex_counts))[:-1]
+
+    # Bounding spheres: Center is the mean of the tri corners, radius the max distance to it
+    bounding_verts = np.concatenate(bounding_verts).astype(np.float64)
+    nonempty = corner_counts > 0
+    segment_starts = (np.cumsum(corner_counts) - corner_counts)[nonempty]
+    centers = np.zeros((num_clusters, 3))
+    centers[nonempty] = np.add.reduceat(bounding_verts, segment_starts) / corner_counts[nonempty, None]
+    dists = np.linalg.norm(bounding_verts - np.repeat(centers, corner_counts, axis=0), axis=1)
+    radii = np.zeros(num_clusters)
+    radii[nonempty] = np.maximum.reduceat(dists, segment_starts)
+
+    # Enforce monotonic cluster error and monotonic increasing bounding spheres (parent fully contains
+    # children), level by level: All children of a lod are in the previous lod
+    for start, end in zip(lod_starts[1:-1], lod_starts[2:]):
+        kids = rev_ids[rev_offsets[start]:rev_offsets[end]]
+        kid_segments = rev_offsets[start:end] - rev_offsets[start]
+        num_kids = np.diff(rev_offsets[start:end + 1])
+
+        kid_error = np.maximum.reduceat(cluster_errors[kids], kid_segments)
+        error = cluster_errors[start:end]
+        # Cheat using an epsilon
+        cluster_errors[start:end] = np.where(error <= kid_error, kid_error * 1.001, error)
+
+        centers[start:end], radii[start:end] = merge_bounding_spheres(
+            np.concatenate([np.arange(start, end), kids]),
+            np.concatenate([np.arange(end - start), np.repeat(np.arange(end - start), num_kids)]),
+            centers,
+            radii,
+        )
+
+    cluster_dag = np.split(dag_ids, dag_offsets[1:-1])
+    cluster_dag_rev = np.split(rev_ids, rev_offsets[1:-1])
+    cluster_verts = np.split(verts, vertex_offsets)
+    cluster_normals = np.split(normals, vertex_offsets)
+    cluster_indices = np.split(indices, np.cumsum(corner_counts)[:-1])
+
+    return (
+        cluster_dag,
+        cluster_dag_rev,
+        cluster_verts,
+        cluster_indices,
+        cluster_normals,
+        cluster_errors,
+        centers,
+        radii,
+    )
+
+
+def merge_bounding_spheres(sphere_ids, merged_ids, centers, radii):
+    # Batched version of minimum_bounding_sphere: Merges the spheres sphere_ids into the spheres
+    # merged_ids (0 .. n - 1). Each merged sphere processes its inputs sorted by decreasing radius,
+    # all merged spheres are processed at once
+    order = np.lexsort((-radii[sphere_ids], merged_ids))
+    sphere_ids = sphere_ids[order]
+    merged_ids = merged_ids[order]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(merged_ids))))
+    rank = np.arange(len(merged_ids)) - offsets[merged_ids]
+
+    # Initialize the bounding spheres to the largest input spheres
+    merged_centers = centers[sphere_ids[offsets[:-1]]].copy()
+    merged_radii = radii[sphere_ids[offsets[:-1]]].copy()
+
+    for i in range(1, rank.max() + 1):
+        step = rank == i
+        merged = merged_ids[step]
+        c = centers[sphere_ids[step]]
+        r = radii[sphere_ids[step]]
+        center = merged_centers[merged]
+        radius = merged_radii[merged]
+        dist = np.linalg.norm(c - center, axis=1)
+
+        # If the current sphere is already contained: Nothing to do
+        # If the bounding sphere is contained within current: Use current
+        enclosing = (dist + radius <= r) & ~(dist + r <= radius)
+        merged_centers[merged[enclosing]] = c[enclosing]
+        merged_radii[merged[enclosing]] = r[enclosing]
+
+        # Otherwise, calculate the new bounding sphere
+        grow = ~(dist + r <= radius) & ~enclosing
+        new_radius = (dist[grow] + radius[grow] + r[grow]) / 2
+        factor = (new_radius - radius[grow]) / dist[grow]
+        merged_centers[merged[grow]] = center[grow] + factor[:, None] * (c[grow] - center[grow])
+        merged_radii[merged[grow]] = new_radius
+
+    return merged_centers, merged_radii
+
+
+def build_cut_groups(dag_offsets, dag, rev_offsets, dag_rev, cluster_errors, centers, radii):
+    # Groups of clusters simplified together (same parents) for the selection of the cut:
+    # A cluster is drawn if the error of its own group is above the threshold (parents too coarse)
+    # and the error of the group of its children is below it (children unnecessarily detailed)
+    # Returns the group of each cluster (cluster 0: -1), the group of its children (LOD 0: -1) and
+    # error and bounding sphere of each group. Both are monotonic: Parent groups contain child groups
+    num_clusters = len(dag_offsets) - 1
+    num_parents = np.diff(dag_offsets)
+    num_children = np.diff(rev_offsets)
+
+    # Parents of different groups are disjoint: The first parent identifies the group (root: itself)
+    first_parent = np.where(num_parents > 0, dag[np.minimum(dag_offsets[:-1], len(dag) - 1)], -1)
+    key = np.where(num_parents > 0, first_parent, num_clusters + np.arange(num_clusters))
+    group_of = np.full(num_clusters, -1, dtype=np.int64)
+    __, group_of[1:] = np.unique(key[1:], return_inverse=True)
+    num_groups = group_of.max() + 1
+
+    first_child = dag_rev[np.minimum(rev_offsets[:-1], len(dag_rev) - 1)]
+    first_child = np.where(num_children > 0, first_child, 0)
+    child_group = np.where(first_child > 0, group_of[first_child], -1)
+    child_group[0] = -1
+
+    group_errors = np.zeros(num_groups)
+    np.maximum.at(group_errors, group_of[1:], cluster_errors[1:])
+
+    # Level of each cluster in the DAG (LOD), groups are merged level by level
+    level = np.zeros(num_clusters, dtype=np.int64)
+    while True:
+        new_level = np.where(first_child > 0, level[first_child] + 1, 0)
+        if np.array_equal(new_level, level):
+            break
+        level = new_level
+
+    all_centers = np.concatenate([centers, np.zeros((num_groups, 3))])
+    all_radii = np.concatenate([radii, np.zeros(num_groups)])
+    for current_level in range(level.max() + 1):
+        members = np.flatnonzero((level == current_level) & (group_of >= 0))
+        groups, local = np.unique(group_of[members], return_inverse=True)
+
+        # Sphere of a group contains its clusters and the groups of their children
+        has_children = child_group[members] >= 0
+        pairs = np.unique(np.stack([local[has_children], child_group[members[has_children]]], axis=1), axis=0)
+        merged_centers, merged_radii = merge_bounding_spheres(
+            np.concatenate([members, num_clusters + pairs[:, 1]]),
+            np.concatenate([local, pairs[:, 0]]),
+            all_centers,
+            all_radii,
+        )
+        # Cheat using an epsilon (containment despite rounding)
+        all_centers[num_clusters + groups] = merged_centers
+        all_radii[num_clusters + groups] = merged_radii * (1 + 1e-6) + 1e-9
+
+    return group_of, child_group, group_errors, all_centers[num_clusters:], all_radii[num_clusters:]
+
+
+def next_lod(lod, config, num_workers=1):
+    # num_workers > 1 simplifies the groups in forked worker processes (None: all cores)
     vertices, tris, adjacencies, clusters, __, __, __ = lod
 
     assert len(tris) == len(clusters)
 
-    # Create a lookup table of cluster to tris_ids
-    cluster_to_tris = defaultdict(list)
-    for i, cluster in enumerate(clusters):
-        cluster_to_tris[cluster].append(i)
+    # Create a lookup table of cluster to tris_ids (CSR: offsets, tri ids sorted by cluster)
+    cluster_to_tris = group_members(clusters)
 
     # Create cluster super-groups
-    num_orig_clusters = len(cluster_to_tris)
+    num_orig_clusters = len(cluster_to_tris[0]) - 1
     if num_orig_clusters > config["group_size"] * 2:
         grouped = group_clusters(clusters, adjacencies, num_orig_clusters // config["group_size"])
     elif num_orig_clusters > 4:
         grouped = group_clusters(clusters, adjacencies, 2)
     else:
-        grouped = [0 for i in range(num_orig_clusters)]
+        grouped = np.zeros(num_orig_clusters, dtype=int)
 
-    clusters_dict = defaultdict(list)
-    for i, group in enumerate(grouped):
-        clusters_dict[group].append(i)
+    group_offsets, grouped_clusters = group_members(grouped)
+    clusters_in_group = np.split(grouped_clusters, group_offsets[1:-1])
 
-    clusters_in_group = []
-    for i in range(max(grouped) + 1):
-        clusters_in_group.append(clusters_dict[i])
+    if num_workers is None:
+        num_workers = available_cpus()
 
-    if parallel:
-        simplified_lod = simplify_groups_parallel(
-            lod, cluster_to_tris, clusters_in_group, config
+    if num_workers > 1 and len(clusters_in_group) > 1:
+        group_lods = simplify_groups_parallel(
+            lod, cluster_to_tris, clusters_in_group, config, num_workers
         )
     else:
-        simplified_lod = simplify_groups(lod, cluster_to_tris, clusters_in_group, config)
+        group_lods = simplify_groups(lod, cluster_to_tris, clusters_in_group, config)
 
-    return simplified_lod
+    # Geometric error of all groups against the full lod (one index, single batched query)
+    errors = RMSErrorIndex(vertices).rms_errors([group_lod[0] for group_lod in group_lods])
+    group_lods = [
+        group_lod[:4] + (error,) + group_lod[5:] for group_lod, error in zip(group_lods, errors)
+    ]
+
+    return combine_group_lods(group_lods, clusters_in_group)
 
 
 def simplify_group(lod, cluster_to_tris, config, group):
     vertices, tris, __, __, __, __, __ = lod
+    offsets, tri_ids = cluster_to_tris
 
-    new_vertices = []
-    new_tris = []
-    vertex_mapping = {}
+    # Concatenate the tri id ranges of all clusters in the group
+    starts = offsets[group]
+    counts = offsets[np.asarray(group) + 1] - starts
+    range_offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    group_tri_ids = tri_ids[range_offsets + np.arange(counts.sum())]
 
-    for cluster_i in group:
-        for tri_i in cluster_to_tris[cluster_i]:
-            verts = []
-            for vertex_i in tris[tri_i]:
-                if vertex_i not in vertex_mapping:
-                    vertex_mapping[vertex_i] = len(new_vertices)
-                    new_vertices.append(vertices[vertex_i])
-                verts.append(vertex_mapping[vertex_i])
-            new_tris.append(verts)
-
-    new_vertices = np.array(new_vertices)
-    new_tris = np.array(new_tris)
+    # Compact the vertices used by the group
+    vertex_ids, new_tris = np.unique(tris[group_tri_ids], return_inverse=True)
+    new_vertices = vertices[vertex_ids]
+    new_tris = new_tris.reshape(-1, 3)
 
     simplified_vertices, simplified_faces, simplified_normals = simplify_mesh_inside(
         new_vertices, new_tris
@@ -295,25 +662,54 @@ def simplify_group(lod, cluster_to_tris, config, group):
         new_adjacencies = None
         new_clusters = np.zeros(len(simplified_faces), dtype=int)
 
-    geometric_error = calc_RMS_error(simplified_vertices, new_vertices)
-
     return (
         simplified_vertices,
         simplified_faces,
         new_adjacencies,
         new_clusters,
         # No graph adjacencies
-        geometric_error,
+        None,  # Geometric error, calculated for all groups at once (see next_lod)
         simplified_normals,
     )
 
 
-def simplify_groups_parallel(lod, cluster_to_tris, clusters_in_group, config):
-    with mp.Pool(int(mp.cpu_count())) as pool:
-        partial_func = partial(simplify_group, lod, cluster_to_tris, config)
-        results = pool.map(partial_func, clusters_in_group, chunksize=1)
+def available_cpus():
+    # Respect the CPU affinity of the process (e.g. on shared build machines)
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return mp.cpu_count()
+
+
+# Read-only state of the lod being simplified, inherited by forked workers
+_worker_state = {}
 
-    return combine_group_lods(results, clusters_in_group)
+
+def _simplify_group_worker(group_id):
+    lod, cluster_to_tris, clusters_in_group, config = _worker_state["args"]
+    return simplify_group(lod, cluster_to_tris, config, clusters_in_group[group_id])
+
+
+def simplify_groups_parallel(lod, cluster_to_tris, clusters_in_group, config, num_workers):
+    # Workers are forked after setting the module state: The lod arrays are shared copy-on-write
+    # and only group ids are sent to the workers (only the simplified groups are sent back)
+    # Fork is only safe on Linux (e.g. not on macOS once a GL context exists)
+    if not sys.platform.startswith("linux"):
+        print("Parallel simplification requires Linux (fork), falling back to a single process.")
+        return simplify_groups(lod, cluster_to_tris, clusters_in_group, config)
+
+    num_workers = min(num_workers, len(clusters_in_group))
+    chunksize = max(1, len(clusters_in_group) // (num_workers * 4))
+
+    _worker_state["args"] = (lod, cluster_to_tris, clusters_in_group, config)
+    try:
+        with mp.get_context("fork").Pool(num_workers) as pool:
+            results = pool.map(
+                _simplify_group_worker, range(len(clusters_in_group)), chunksize=chunksize
+            )
+    finally:
+        _worker_state.clear()
+
+    return results
 
 
 def simplify_groups(lod, cluster_to_tris, clusters_in_group, config):
@@ -321,20 +717,18 @@ def simplify_groups(lod, cluster_to_tris, clusters_in_group, config):
     for group in clusters_in_group:
         simplified_lods.append(simplify_group(lod, cluster_to_tris, config, group))
 
-    return combine_group_lods(simplified_lods, clusters_in_group)
+    return simplified_lods
 
 
 def combine_group_lods(group_lods, clusters_in_group):
     # Combine lods into a single mesh, returns a new lod
     # Indices for vertices and clusters are updated for the new lod
-    new_vertices = []
     new_tris = []
     new_clusters = []
-    new_normals = []
 
     num_clusters = 0
+    num_vertices = 0
     start_clusters = sum([len(i) for i in clusters_in_group])
-    vertex_mapping = {}
 
     graph_adjacencies = {}
     geometric_errors = {}
@@ -342,18 +736,10 @@ def combine_group_lods(group_lods, clusters_in_group):
     for i, lod in enumerate(group_lods):
         vertices, tris, adjacencies, clusters, geometric_error, normals = lod
 
-        vertices = [tuple(vertex) for vertex in vertices]
-
-        for vert_i, vertex in enumerate(vertices):
-            if vertex not in vertex_mapping:
-                vertex_mapping[vertex] = len(new_vertices)
-                new_vertices.append(vertex)
-                new_normals.append(normals[vert_i])
+        new_tris.append(tris + num_vertices)
+        num_vertices += len(vertices)
 
-        for tri in tris:
-            new_tris.append([vertex_mapping[vertices[vertex]] for vertex in tri])
-
-        n_clust = max(clusters) + 1
+        n_clust = clusters.max() + 1
 
         adj_clusters = np.array(range(num_clusters, num_clusters + n_clust))
         for cluster_i in clusters_in_group[i]:
@@ -367,11 +753,22 @@ def combine_group_lods(group_lods, clusters_in_group):
     graph_adjacencies = [graph_adjacencies[i] for i in range(start_clusters)]
     geometric_errors = [geometric_errors[i] for i in range(len(geometric_errors))]
 
+    # Weld vertices shared between groups (group borders are preserved during simplification)
+    # Unique vertices keep the order of their first occurrence and its normal
+    all_vertices = np.concatenate([lod[0] for lod in group_lods])
+    all_normals = np.concatenate([lod[5] for lod in group_lods])
+    __, first_index, inverse = np.unique(
+        all_vertices, axis=0, return_index=True, return_inverse=True
+    )
+    order = np.argsort(first_index)
+    remap = np.empty(len(order), dtype=np.int64)
+    remap[order] = np.arange(len(order))
+
+    new_vertices = all_vertices[first_index[order]]
+    new_normals = all_normals[first_index[order]]
+    new_tris = remap[inverse.reshape(-1)][np.concatenate(new_tris)]
     new_clusters = np.concatenate(new_clusters)
-    new_vertices = np.array(new_vertices)
-    new_normals = np.array(new_normals)
-    new_tris = np.array(new_tris)
-    new_adjacencies = create_dual_graph(new_tris)
+    new_adjacencies = create_dual_graph_csr(new_tris)
 
     return (
         new_vertices,
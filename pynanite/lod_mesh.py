@@ -1,4 +1,5 @@
 import numpy as np
+from OpenGL.GL import glPushMatrix, glPopMatrix, glTranslatef
 
 from .cluster_mesh import ClusterMesh
 
@@ -6,26 +7,60 @@ THRESHOLD = 0.00006
 MARGIN = 0.00003 # Unfortunately we need this hysteresis? The error and radii should be monotonic!
 
 class LODMesh:
-    def __init__(self, lod_dag, camera, position):
+    def __init__(self, lod_dag, camera, position, residency=None):
+        # An instance of lod_dag (geometry is shared), position: Translation applied when drawing
+        # residency: Optional ResidencyManager, clusters are loaded on demand
         self.lod_dag = lod_dag
         self.camera = camera
-        self.position = position
-        self.cluster_mesh = ClusterMesh(
-            position,
-            lod_dag.cluster_verts,
-            lod_dag.cluster_textures,
-            lod_dag.texture_id,
-            lod_dag.cluster_normals,
-        )
-
-        self.spheres = self.lod_dag.cluster_bounding_centers + position
-        self.last_cluster = len(self.lod_dag.cluster_verts) - 1
+        self.position = np.array(position, dtype=np.float64)
+        self.residency = residency
+        self.last_cluster = len(self.lod_dag.cluster_dag) - 1
+        lod_dag.cut_groups  # Built here (render thread), cut selection on a worker only reads it
+
+        # All clusters are uploaded at once, or while they are drawn (loaded on demand)
+        # The root is retained twice: For the cut and while the instance exists (see show_root_if_culled)
+        self.buffers = lod_dag.gpu_buffers
+        if residency is None:
+            self.buffers.upload_all()
+            self.cluster_geometry = lod_dag.cluster_geometry
+        else:
+            residency.retain(lod_dag, [self.last_cluster] * 2)
+            def cluster_geometry(cluster):
+                return residency.get(lod_dag, cluster, wait=True)
+            self.cluster_geometry = cluster_geometry
+        self.buffers.retain([self.last_cluster] * 2, self.cluster_geometry)
+
+        self.cluster_mesh = ClusterMesh(self.buffers, lod_dag.texture_id, self.last_cluster)
 
     def debug_set_min_lod(self):
-        self.cluster_mesh.set_clusters({len(self.lod_dag.cluster_verts) - 1})
+        self.set_clusters({self.last_cluster})
 
     def debug_set_max_lod(self):
-        self.cluster_mesh.set_clusters(self.lod_dag.cluster_dag[0])
+        self.set_clusters(set(self.lod_dag.cluster_dag[0]))
+
+    def set_clusters(self, clusters, prepared=None):
+        # prepared: Optional arrays to draw the clusters, see ClusterMesh.prepare
+        added = clusters - self.cluster_mesh.clusters
+        removed = self.cluster_mesh.clusters - clusters
+        if self.residency is not None:
+            self.residency.retain(self.lod_dag, added)
+            self.residency.release(self.lod_dag, removed)
+        self.buffers.retain(added, self.cluster_geometry)
+        self.buffers.release(removed)
+        self.cluster_mesh.set_clusters(clusters, prepared)
+
+    def upload_bytes(self, clusters):
+        # GPU upload of a switch to clusters
+        return self.buffers.upload_bytes(clusters - self.cluster_mesh.clusters)
+
+    def is_resident(self, clusters):
+        # Clusters that are still loading are not switched to yet (the current ones are kept)
+        return self.residency is None or self.residency.ready(self.lod_dag, clusters)
+
+    def show_root_if_culled(self):
+        # An instance that was culled draws the root (always loaded) while its new cut is loading
+        if not self.cluster_mesh.clusters:
+            self.set_clusters({self.last_cluster})
 
     def step_graph_cut(self, num_steps=3):
         any_change = False
@@ -50,6 +85,8 @@ class LODMesh:
                 if cluster_error < THRESHOLD - MARGIN:
                     if cluster != self.last_cluster:
                         parents = self.lod_dag.cluster_dag[cluster]
+                        if not self.is_resident(parents):
+                            continue
                         for p in parents:
                             to_remove.update(self.lod_dag.cluster_dag_rev[p])
                         to_add.update(parents)
@@ -57,7 +94,7 @@ class LODMesh:
                 # Refinement (increase lod)
                 elif cluster_error > THRESHOLD + MARGIN:
                     all_kids = self.lod_dag.cluster_dag_rev[cluster]
-                    if all_kids[0] != 0:
+                    if all_kids[0] != 0 and self.is_resident(all_kids):
                         to_add.update(all_kids)
                         for k in all_kids:
                             to_remove.update(self.lod_dag.cluster_dag[k])
@@ -75,17 +112,18 @@ class LODMesh:
                 break
 
         if any_change:
-            self.cluster_mesh.set_clusters(current_clusters)
+            self.set_clusters(current_clusters)
 
         return any_change
 
     def calc_screen_space_error(self, clusters):
-        dists = np.linalg.norm(self.camera.position - self.spheres[clusters], axis=1)
+        spheres = self.lod_dag.cluster_bounding_centers[clusters] + self.position
+        dists = np.linalg.norm(self.camera.position - spheres, axis=1)
         dists -= self.lod_dag.cluster_bounding_radii[clusters]
         result = self.lod_dag.cluster_errors[clusters] / dists
 
         # Culling
-        in_front = self.camera.check_in_front(self.spheres[clusters])
+        in_front = self.camera.check_spheres_in_frustum(spheres, self.lod_dag.cluster_bounding_radii[clusters])
         result[~in_front] = 0
 
         # We are inside the bounding sphere
@@ -94,7 +132,15 @@ class LODMesh:
         return result
 
     def update(self):
+        if not self.cluster_mesh.clusters:
+            return  # Culled
+        glPushMatrix()
+        glTranslatef(*self.position)
         self.cluster_mesh.draw()
+        glPopMatrix()
 
     def shutdown(self):
-        self.cluster_mesh.shutdown()
+        clusters = list(self.cluster_mesh.clusters) + [self.last_cluster]
+        if self.residency is not None:
+            self.residency.release(self.lod_dag, clusters)
+        self.buffers.release(clusters)
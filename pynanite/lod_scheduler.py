@@ -0,0 +1,48 @@
+from time import perf_counter
+
+
+class LODUpdateScheduler:
+    """Applies pending cut changes by priority within a per-frame budget, the rest waits.
+
+    Each mesh has at most one pending cut (a newer one replaces it), cuts are applied as a whole and
+    stay valid. At least one cut is applied per frame. Budgets: time in seconds and bytes uploaded
+    to the GPU, None for no limit.
+    """
+
+    def __init__(self, time_budget=0.004, byte_budget=16 * 1024**2):
+        self.time_budget = time_budget
+        self.byte_budget = byte_budget
+        self.pending = {}  # mesh -> (priority, clusters, prepared)
+
+    def submit(self, cuts):
+        # cuts: List of (mesh, clusters, priority, prepared), see CutSelector.select_cuts
+        for mesh, clusters, priority, prepared in cuts:
+            if clusters == mesh.cluster_mesh.clusters:
+                self.pending.pop(mesh, None)
+            else:
+                self.pending[mesh] = (priority, clusters, prepared)
+
+    def update(self):
+        # Call once per frame, returns the number of applied cuts
+        start = perf_counter()
+        uploaded_bytes = 0
+        applied = 0
+        for mesh in sorted(self.pending, key=lambda mesh: self.pending[mesh][0], reverse=True):
+            if applied > 0 and self.time_budget is not None and perf_counter() - start > self.time_budget:
+                break
+
+            __, clusters, prepared = self.pending[mesh]
+            # Clusters that are still loading are not switched to yet (the current ones are kept)
+            if not mesh.is_resident(clusters):
+                mesh.show_root_if_culled()
+                continue
+
+            cost = mesh.upload_bytes(clusters)
+            if applied > 0 and self.byte_budget is not None and uploaded_bytes + cost > self.byte_budget:
+                break
+
+            mesh.set_clusters(clusters, prepared)
+            del self.pending[mesh]
+            uploaded_bytes += cost
+            applied += 1
+        return applied
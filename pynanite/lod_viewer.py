@@ -27,7 +27,10 @@ from OpenGL.GL import (
 # os.environ["METIS_DLL"] = os.path.join(current_path, "libmetis.so")
 
 
-from pynanite import LODMesh, LODGraph, Camera, __version__
+from pynanite import (
+    LODMesh, LODGraph, BakeCache, Camera, AsyncCutSelector, LODUpdateScheduler, ResidencyManager,
+    SceneGrid, __version__
+)
 
 
 STATS_DELAY = 1.0
@@ -35,7 +38,9 @@ STATS_DELAY = 1.0
 
 class LODTrisViewer:
     def __init__(self, models, display_dim=(1920, 1080), profile_meshing=False, force_mesh_build=False,
-                cluster_size_initial=160, cluster_size=128, group_size=8):
+                cluster_size_initial=160, cluster_size=128, group_size=8, num_workers=1,
+                cache_dir="data/build/cache", quantize_error=None, residency_budget=None,
+                lod_time_budget=0.004, lod_byte_budget=16 * 1024**2, lod_max_distance=None):
         
         print(f"Starting pynanite {__version__}")
         
@@ -57,6 +62,24 @@ class LODTrisViewer:
         self._init_opengl()
 
         self.meshes = []
+        # Instances by position: Only visible ones are selected and drawn
+        self.scene = SceneGrid()
+
+        # Cut changes are applied by priority within a per-frame budget (seconds, bytes uploaded)
+        self.lod_scheduler = LODUpdateScheduler(lod_time_budget, lod_byte_budget)
+        # Cuts are selected on a worker thread, the render loop only swaps them in
+        # Instances further away than lod_max_distance are not drawn (None: up to the far plane)
+        self.cut_selector = AsyncCutSelector(
+            self.camera, scheduler=self.lod_scheduler, max_distance=lod_max_distance
+        )
+
+        # Baked models are cached by content of the source files and the bake config
+        cache = BakeCache(cache_dir) if cache_dir is not None else None
+
+        # Load clusters on demand within a memory budget (bytes), None: All clusters stay in memory
+        self.residency = None
+        if residency_budget is not None:
+            self.residency = ResidencyManager(residency_budget)
 
         if profile_meshing:
             profiler = Profile()
@@ -67,7 +90,10 @@ class LODTrisViewer:
                                     force_mesh_build,
                                     cluster_size_initial,
                                     cluster_size,
-                                    group_size
+                                    group_size,
+                                    num_workers,
+                                    cache,
+                                    quantize_error
                                 ) for k, v in models.items()}
 
         if profile_meshing:
@@ -94,13 +120,14 @@ class LODTrisViewer:
         glLightfv(GL_LIGHT0, GL_DIFFUSE, [1.0, 1.0, 1.0, 1.0])
         glLightfv(GL_LIGHT0, GL_POSITION, [0.0, 0.0, 10.0, 0.0])
 
+        # The camera culls against the same projection
+        self.camera = Camera(45, self.aspect_ratio, 0.1, 200.0)
         glMatrixMode(GL_PROJECTION)
-        gluPerspective(45, self.aspect_ratio, 0.1, 200.0)
+        gluPerspective(self.camera.fov, self.camera.aspect_ratio, self.camera.near, self.camera.far)
         glEnable(GL_DEPTH_TEST)
         glEnable(GL_CULL_FACE)
 
         glMatrixMode(GL_MODELVIEW)
-        self.camera = Camera()
 
         # glClear(GL_COLOR_BUFFER_BIT)
         pygame.display.flip()
@@ -111,8 +138,9 @@ class LODTrisViewer:
             profiler.enable()
 
         position = np.array(position)
-        mesh = LODMesh(self.models[model_name], self.camera, position)
+        mesh = LODMesh(self.models[model_name], self.camera, position, self.residency)
         self.meshes.append(mesh)
+        self.scene.insert(mesh)
 
         if profile:
             profiler.disable()
@@ -155,9 +183,15 @@ class LODTrisViewer:
                     ]
                 )
             
+            self.cut_selector.shutdown()
+
             # Delete all VBOs properly
             for mesh in self.meshes:
                 mesh.shutdown()
+            for model in self.models.values():
+                model.shutdown()
+            if self.residency is not None:
+                self.residency.shutdown()
 
         self.last_time = time()
         self.next_stats_time = time() + STATS_DELAY
@@ -192,15 +226,20 @@ class LODTrisViewer:
             glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
             self._handle_inputs()
 
-            for mesh in self.meshes:
-                if self.dynamicLOD:
-                    mesh.step_graph_cut()
+            if self.residency is not None:
+                self.residency.update()
+
+            drawn_meshes = self.meshes
+            if self.dynamicLOD:
+                self.cut_selector.update(self.scene)
+                drawn_meshes = self.cut_selector.visible_meshes
+            for mesh in drawn_meshes:
                 mesh.update()
 
             # A stats display, updated every second
             if cur_time > self.next_stats_time:
                 self.next_stats_time = cur_time + STATS_DELAY
-                triangles = sum([m.cluster_mesh.num_vertices // 9 for m in self.meshes])
+                triangles = sum([m.cluster_mesh.num_indices // 3 for m in drawn_meshes])
                 triangles = round(triangles / 1000000, 3)
 
                 fps = 1 / self.delta
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ResidencyManager:
+    """Cluster geometry loaded on demand from baked models (shared by all meshes).
+
+    Loads run in a background thread, least recently used clusters are evicted once the loaded
+    geometry exceeds budget_bytes. Retained clusters (currently drawn) are never evicted.
+    """
+
+    def __init__(self, budget_bytes=512 * 1024**2, num_threads=1):
+        self.budget_bytes = budget_bytes
+        self.resident = OrderedDict()  # (graph, cluster) -> geometry, least recently used first
+        self.loading = {}  # (graph, cluster) -> future
+        self.retained = {}  # (graph, cluster) -> number of meshes drawing it
+        self.resident_bytes = 0
+        self.executor = ThreadPoolExecutor(num_threads)
+
+    def get(self, graph, cluster, wait=False):
+        # Geometry of a cluster (see LODGraph.load_cluster) or None while it is loading
+        key = (graph, cluster)
+        geometry = self.resident.get(key)
+        if geometry is not None:
+            self.resident.move_to_end(key)
+            return geometry
+
+        future = self.loading.get(key)
+        if future is None:
+            future = self.loading[key] = self.executor.submit(graph.load_cluster, cluster)
+        if not wait:
+            return None
+
+        return self._make_resident(key, future.result())
+
+    def ready(self, graph, clusters):
+        # Are all clusters resident? Missing clusters are requested
+        ready = True
+        for cluster in clusters:
+            if self.get(graph, cluster) is None:
+                ready = False
+        return ready
+
+    def retain(self, graph, clusters):
+        for cluster in clusters:
+            key = (graph, cluster)
+            self.retained[key] = self.retained.get(key, 0) + 1
+
+    def release(self, graph, clusters):
+        for cluster in clusters:
+            key = (graph, cluster)
+            self.retained[key] -= 1
+            if self.retained[key] == 0:
+                del self.retained[key]
+
+    def update(self):
+        # Call once per frame: Finished loads become resident, then evict
+        for key, future in list(self.loading.items()):
+            if future.done():
+                self._make_resident(key, future.result())
+        self.evict()
+
+    def evict(self):
+        for key in list(self.resident.keys()):
+            if self.resident_bytes <= self.budget_bytes:
+                break
+            if key not in self.retained:
+                geometry = self.resident.pop(key)
+                self.resident_bytes -= sum(array.nbytes for array in geometry)
+
+    def _make_resident(self, key, geometry):
+        del self.loading[key]
+        if key not in self.resident:
+            self.resident[key] = geometry
+            self.resident_bytes += sum(array.nbytes for array in geometry)
+        return self.resident[key]
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
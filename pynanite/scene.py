@@ -0,0 +1,74 @@
+import threading
+
+import numpy as np
+
+
+class SceneGrid:
+    """Uniform grid over the root bounding spheres of the instances, for culling whole cells first.
+
+    An instance is stored in the cell of its sphere center, a cell is tested as a sphere around the
+    cell that contains the spheres of all its instances. Inserting is cheap (amortized O(1), the
+    cell arrays are rebuilt on the next query). Instances are not moved.
+    """
+
+    def __init__(self, cell_size=10.0):
+        self.cell_size = cell_size
+        self.meshes = []
+        self.centers = np.zeros((64, 3))
+        self.radii = np.zeros(64)
+        self.cells = {}  # (i, j, k) -> list of instance ids
+        self.cell_radii = {}  # (i, j, k) -> largest sphere radius of the instances
+        self.inserted = []  # Meshes inserted since the last take_inserted
+        self.lock = threading.Lock()
+        self._cell_arrays = None
+
+    def insert(self, mesh):
+        # The root cluster bounds the whole instance
+        center = mesh.lod_dag.cluster_bounding_centers[-1] + mesh.position
+        radius = mesh.lod_dag.cluster_bounding_radii[-1]
+        key = tuple(np.floor(center / self.cell_size).astype(int).tolist())
+
+        with self.lock:
+            instance = len(self.meshes)
+            if instance == len(self.radii):
+                self.centers = np.concatenate([self.centers, np.zeros_like(self.centers)])
+                self.radii = np.concatenate([self.radii, np.zeros_like(self.radii)])
+            self.meshes.append(mesh)
+            self.centers[instance] = center
+            self.radii[instance] = radius
+            self.cells.setdefault(key, []).append(instance)
+            self.cell_radii[key] = max(self.cell_radii.get(key, 0.0), radius)
+            self.inserted.append(mesh)
+            self._cell_arrays = None
+
+    def take_inserted(self):
+        with self.lock:
+            inserted, self.inserted = self.inserted, []
+        return inserted
+
+    def query(self, camera, max_distance=None):
+        # Meshes with their root sphere in the view frustum (and within max_distance of the camera)
+        with self.lock:
+            if self._cell_arrays is None:
+                keys = list(self.cells)
+                self._cell_arrays = (
+                    (np.array(keys, dtype=np.float64).reshape(-1, 3) + 0.5) * self.cell_size,
+                    np.array([self.cell_radii[key] for key in keys]) + np.sqrt(3) / 2 * self.cell_size,
+                    [np.array(self.cells[key]) for key in keys],
+                )
+            cell_centers, cell_radii, cell_instances = self._cell_arrays
+            centers, radii, meshes = self.centers, self.radii, self.meshes
+
+        # Cells first, then the instances of the remaining cells
+        visible_cells = self._check_spheres(camera, cell_centers, cell_radii, max_distance)
+        if not visible_cells.any():
+            return []
+        instances = np.concatenate([cell_instances[cell] for cell in np.flatnonzero(visible_cells)])
+        visible = self._check_spheres(camera, centers[instances], radii[instances], max_distance)
+        return [meshes[instance] for instance in instances[visible]]
+
+    def _check_spheres(self, camera, centers, radii, max_distance):
+        visible = camera.check_spheres_in_frustum(centers, radii)
+        if max_distance is not None:
+            visible &= np.linalg.norm(centers - camera.position, axis=-1) - radii <= max_distance
+        return visible
@@ -0,0 +1,35 @@
+import numpy as np
+from PIL import Image
+from OpenGL.GL import (
+    glGenTextures, glBindTexture, glTexParameterf, glTexImage2D,
+    GL_TEXTURE_2D, GL_LINEAR, GL_RGB, GL_UNSIGNED_BYTE,
+    GL_TEXTURE_MAG_FILTER, GL_TEXTURE_MIN_FILTER
+)
+
+
+def load_texture(path):
+    # Load texture
+    img = Image.open(path)
+    img = img.transpose(Image.FLIP_TOP_BOTTOM)
+    img_data = np.array(img, dtype=np.uint8)
+
+    # Generate a texture id
+    texture_id = glGenTextures(1)
+
+    glBindTexture(GL_TEXTURE_2D, texture_id)
+    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexImage2D(
+        GL_TEXTURE_2D,
+        0,
+        GL_RGB,
+        img.width,
+        img.height,
+        0,
+        GL_RGB,
+        GL_UNSIGNED_BYTE,
+        img_data,
+    )
+
+    # print(f"Loaded texture {path} ({img.width} x {img.height}) with id {texture_id}")
+    return texture_id
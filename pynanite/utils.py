@@ -1,121 +1,227 @@
 from itertools import combinations
 from collections import defaultdict
+from time import time
+import os
+import zipfile
 
 import numpy as np
 import pymetis
-from PIL import Image
 from pyfqmr import Simplify
 from scipy.spatial import KDTree
 
-from OpenGL.GL import (
-    glGenTextures, glBindTexture, glTexParameterf, glTexImage2D, 
-    GL_TEXTURE_2D, GL_LINEAR, GL_RGB, GL_UNSIGNED_BYTE,
-    GL_TEXTURE_MAG_FILTER, GL_TEXTURE_MIN_FILTER
-)
-
-
-def load_obj(path):
-    vertices = []
-    tris = []
-    texture_coords = []
-    normals = []
-    vertex_vt_map = {}
-    vertex_vn_map = {}
-
-    with open(path, "r") as f:
-        lines = f.readlines()
-
-    for line in lines:
-        if line.startswith("v "):
-            vertices.append([float(v) for v in line.split()[1:]])
-        elif line.startswith("vt "):
-            texture_coords.append([float(v) for v in line.split()[1:]])
-        elif line.startswith("vn "):
-            normals.append([float(v) for v in line.split()[1:]])
-        elif line.startswith("f "):
-            elements = line.split()[1:]
-            tri = []
-            for element in elements:
-                els = element.split("/")
-
-                v = int(els[0]) - 1  # NOTE: -1 because obj indices start at 1
-                t = int(els[1]) - 1 if len(els) > 1 and els[1] else 0
-                n = int(els[2]) - 1 if len(els) > 2 and els[2] else 0
-
-                vertex_vt_map[v] = t
-                vertex_vn_map[v] = n
-
-                tri.append(v)
-
-            # Convert quads to tris
-            if len(tri) == 4:
-                tris.append([tri[0], tri[1], tri[2]])
-                tris.append([tri[0], tri[2], tri[3]])
-            else:
-                tris.append(tri)
-
-    try:
-        texture_coords = [
-            texture_coords[vertex_vt_map[i]] for i in range(len(vertices))
-        ]
-    except IndexError:
+
+def load_obj(path, use_cache=True):
+    # Parsed arrays are cached in a sidecar file next to the obj (e.g. cat.obj.npz)
+    # The cache is invalidated whenever size or modification time of the obj change
+    start_time = time()
+    cache_path = path + ".npz"
+    stat = os.stat(path)
+    source_key = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cached:
+                if np.array_equal(cached["source_key"], source_key):
+                    vertices = cached["vertices"]
+                    tris = cached["tris"]
+                    texture_coords = cached["texture_coords"]
+                    normals = cached["normals"]
+                    print(
+                        "Loaded %d vertices and %d tris from cache in %.3fs"
+                        % (len(vertices), len(tris), time() - start_time)
+                    )
+                    return vertices, tris, texture_coords, normals
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            # Broken cache file (e.g. interrupted write): Parse again
+            pass
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    vertices, tris, texture_coords, normals = parse_obj(data)
+
+    if use_cache:
+        # Write to a temporary file first, the cache only appears once it is complete
+        temp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        try:
+            with open(temp_path, "wb") as f:
+                np.savez(
+                    f,
+                    source_key=source_key,
+                    vertices=vertices,
+                    tris=tris,
+                    texture_coords=texture_coords,
+                    normals=normals,
+                )
+            os.replace(temp_path, cache_path)
+        except OSError:
+            print("Could not write obj cache %s" % cache_path)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    print(
+        "Loaded %d vertices and %d tris in %.3fs"
+        % (len(vertices), len(tris), time() - start_time)
+    )
+    return vertices, tris, texture_coords, normals
+
+
+def parse_obj(data):
+    # Bulk parser for the bytes of an obj file: Every section (v, vt, vn, f) is cut out of
+    # the buffer in runs of consecutive lines and converted with a single np.fromstring call
+    if not data.endswith(b"\n"):
+        data += b"\n"
+    buf = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == ord("\n")) + 1
+    line_starts = np.concatenate(([0], line_ends[:-1]))
+
+    # Classify lines by their first two characters
+    first = buf[line_starts]
+    second = buf[np.minimum(line_starts + 1, len(buf) - 1)]
+    is_v = first == ord("v")
+    sections = {
+        "v": is_v & (second == ord(" ")),
+        "vt": is_v & (second == ord("t")),
+        "vn": is_v & (second == ord("n")),
+        "f": (first == ord("f")) & (second == ord(" ")),
+    }
+
+    def section_bytes(mask, delete):
+        # Concatenated lines of the section without keywords (sections are mostly contiguous)
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.view(np.int8), [0]))))
+        runs = zip(line_starts[edges[::2]], line_ends[edges[1::2] - 1])
+        return b"".join([data[start:end] for start, end in runs]).translate(None, delete)
+
+    def parse_floats(mask, delete, width):
+        if not np.any(mask):
+            return np.zeros((0, width), dtype=np.float64)
+        text = section_bytes(mask, delete)
+        columns = len(text[: text.index(b"\n")].split())
+        values = np.fromstring(text, dtype=np.float64, sep=" ")
+        if values.size != np.count_nonzero(mask) * columns:
+            # Varying number of values per line (e.g. optional w), parse line by line
+            lines = text.splitlines()
+            return np.array([line.split()[:width] for line in lines], dtype=np.float64)
+        return values.reshape(-1, columns)[:, :width]
+
+    vertices = parse_floats(sections["v"], b"v", 3)
+    texture_coords = parse_floats(sections["vt"], b"vt", 2)
+    normals = parse_floats(sections["vn"], b"vn", 3)
+
+    # Faces: Corners as (v, t, n) obj indices, 0 if not given
+    face_lines = np.flatnonzero(sections["f"])
+    if len(face_lines):
+        indices, num_corners = parse_obj_faces(section_bytes(sections["f"], b"f"), len(face_lines))
+    else:
+        indices, num_corners = np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Resolve 1-based and negative indices (relative to the elements declared before the face)
+    corner_lines = np.repeat(face_lines, num_corners)
+    for column, name in enumerate(["v", "vt", "vn"]):
+        ids = indices[:, column]
+        resolved = ids - 1
+        negative = ids < 0
+        if np.any(negative):
+            resolved[negative] = ids[negative] + np.cumsum(sections[name])[corner_lines[negative]]
+        indices[:, column] = np.where(ids == 0, 0, resolved)
+    has_t = np.any(indices[:, 1])
+    has_n = np.any(indices[:, 2])
+
+    # Fan triangulation of all faces (quads become [0, 1, 2] and [0, 2, 3])
+    num_face_tris = np.maximum(num_corners - 2, 0)
+    first_tri = np.cumsum(num_face_tris) - num_face_tris
+    tri_face = np.repeat(np.arange(len(num_corners)), num_face_tris)
+    tri_step = np.arange(len(tri_face)) - first_tri[tri_face]
+    first_corner = (np.cumsum(num_corners) - num_corners)[tri_face]
+    corners = np.stack(
+        [first_corner, first_corner + tri_step + 1, first_corner + tri_step + 2], axis=1
+    )
+    tris = indices[corners, 0]
+
+    # Per vertex lookup of texture coords and normals (last reference wins)
+    vertex_ids = indices[:, 0]
+    vertex_vt = np.zeros(len(vertices), dtype=np.int64)
+    vertex_vn = np.zeros(len(vertices), dtype=np.int64)
+    if has_t:
+        vertex_vt[vertex_ids] = indices[:, 1]
+    if has_n:
+        vertex_vn[vertex_ids] = indices[:, 2]
+
+    if len(texture_coords) and np.all(vertex_vt < len(texture_coords)):
+        texture_coords = texture_coords[vertex_vt].astype(np.float32)
+    else:
         print("Invalid textures")
-        texture_coords = [[0, 0] for _ in range(len(vertices))]
-    texture_coords = np.array(texture_coords, dtype=np.float32)
+        texture_coords = np.zeros((len(vertices), 2), dtype=np.float32)
 
-    try:
-        normals = [normals[vertex_vn_map[i]] for i in range(len(vertices))]
-    except IndexError:
+    if len(normals) and np.all(vertex_vn < len(normals)):
+        normals = normals[vertex_vn].astype(np.float32)
+    else:
         print("Invalid normals")
-        normals = [[0, 1, 0] for _ in range(len(vertices))]
-
-    normals = np.array(normals, dtype=np.float32)
+        normals = np.zeros((len(vertices), 3), dtype=np.float32)
+        normals[:, 1] = 1
 
     # Scaling the vertices 0 - 1
-    vertices = np.array(vertices)
-
     min_axis = np.min(vertices)
     vertices -= min_axis
 
     max_axis = np.max(vertices)
     vertices /= max_axis
 
-    tris = np.array(tris)
-
-    print("Loaded %d vertices and %d tris" % (len(vertices), len(tris)))
     return vertices.astype(np.float32), tris, texture_coords, normals
 
 
-def load_texture(path):
-    # Load texture
-    img = Image.open(path)
-    img = img.transpose(Image.FLIP_TOP_BOTTOM)
-    img_data = np.array(img, dtype=np.uint8)
-
-    # Generate a texture id
-    texture_id = glGenTextures(1)
-
-    glBindTexture(GL_TEXTURE_2D, texture_id)
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-    glTexImage2D(
-        GL_TEXTURE_2D,
-        0,
-        GL_RGB,
-        img.width,
-        img.height,
-        0,
-        GL_RGB,
-        GL_UNSIGNED_BYTE,
-        img_data,
-    )
-
-    # print(f"Loaded texture {path} ({img.width} x {img.height}) with id {texture_id}")
-    return texture_id
+def parse_obj_faces(text, num_faces):
+    # Face lines without keyword, each corner is one of v, v/t, v//n or v/t/n
+    # Returns the corners as (v, t, n) obj indices (0 if not given) and the corners per face
+    corner_format = text.split(None, 1)[0]
+    parts = corner_format.split(b"/")
+    columns = [0] + [1] * (len(parts) > 1 and parts[1] != b"") + [2] * (len(parts) > 2 and parts[2] != b"")
+
+    # All corners have to use the format of the first corner
+    values = np.fromstring(text.replace(b"/", b" "), dtype=np.int64, sep=" ")
+    total_corners = values.size // len(columns)
+    if (
+        values.size % len(columns)
+        or text.count(b"/") != total_corners * (len(parts) - 1)
+        or text.count(b"//") != total_corners * corner_format.count(b"//")
+    ):
+        return parse_obj_faces_by_line(text)
+
+    if total_corners == 3 * num_faces:
+        # Only tris (every face has at least three corners)
+        num_corners = np.full(num_faces, 3)
+    else:
+        # Count the corners of every face (a corner starts after whitespace)
+        chars = np.frombuffer(text, dtype=np.uint8)
+        is_space = chars <= ord(" ")
+        corner_starts = np.flatnonzero(~is_space & np.concatenate(([True], is_space[:-1])))
+        face_of_corner = np.searchsorted(np.flatnonzero(chars == ord("\n")), corner_starts)
+        num_corners = np.bincount(face_of_corner, minlength=num_faces)
+        if num_corners.sum() != total_corners:
+            return parse_obj_faces_by_line(text)
+
+    indices = np.zeros((total_corners, 3), dtype=np.int64)
+    indices[:, columns] = values.reshape(-1, len(columns))
+    return indices, num_corners
+
+
+def parse_obj_faces_by_line(text):
+    # Slow fallback for faces mixing different corner formats
+    indices = []
+    num_corners = []
+    for line in text.splitlines():
+        elements = line.split()
+        num_corners.append(len(elements))
+        for element in elements:
+            els = element.split(b"/") + [b"", b""]
+            indices.append([int(e) if e else 0 for e in els[:3]])
+
+    return np.array(indices, dtype=np.int64).reshape(-1, 3), np.array(num_corners, dtype=np.int64)
 
 
 def create_dual_graph(tris):
-    # Create an unweighted dual graph of the mesh tris
+    # Create an unweighted dual graph of the mesh tris as adjacency lists
+    # NOTE: Slow fallback, the bake uses create_dual_graph_csr
     edge_to_tri = defaultdict(list)
     for i, tri in enumerate(tris):
         tri = sorted(tri)
@@ -131,50 +237,133 @@ def create_dual_graph(tris):
     return [adjacency[i] for i in range(len(tris))]
 
 
-def create_dual_graph_clusters(member_adjacencies, clusters_membership):
-    # Returns a weighted adjacency list of the dual graph of the clusters
-    dual_graph_clusters = defaultdict(lambda: defaultdict(int))
+def create_dual_graph_csr(tris):
+    # Create an unweighted dual graph of the mesh tris in CSR form (xadj, adjncy)
+    # Tris sharing an edge are found by sorting the edges packed into int64 keys
+    tris = np.asarray(tris, dtype=np.int64).reshape(-1, 3)
+    num_tris = len(tris)
+    num_verts = int(tris.max()) + 1 if num_tris else 0
+
+    first = tris[:, [0, 0, 1]].ravel()
+    second = tris[:, [1, 2, 2]].ravel()
+    edge_keys = np.minimum(first, second) * num_verts + np.maximum(first, second)
+    order = np.argsort(edge_keys, kind="stable")
+    edge_keys = edge_keys[order]
+    edge_tris = order // 3
+
+    # Tris of the same edge are consecutive, pair every tri with all others of its edge
+    sources = []
+    targets = []
+    offset = 1
+    while True:
+        shared = edge_keys[offset:] == edge_keys[:-offset]
+        if not np.any(shared):
+            break
+        sources.append(edge_tris[:-offset][shared])
+        targets.append(edge_tris[offset:][shared])
+        offset += 1
+
+    if sources:
+        sources = np.concatenate(sources)
+        targets = np.concatenate(targets)
+    else:
+        sources = targets = np.zeros(0, dtype=np.int64)
+
+    # Both directions, without self loops and duplicates (sorted by source)
+    sources, targets = np.concatenate([sources, targets]), np.concatenate([targets, sources])
+    pair_keys = np.unique((sources * num_tris + targets)[sources != targets])
+    sources = pair_keys // num_tris
+
+    xadj = np.zeros(num_tris + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=num_tris), out=xadj[1:])
+    adjncy = (pair_keys % num_tris).astype(np.int32)
+    return xadj, adjncy
+
+
+def group_members(membership):
+    # CSR lookup of the members of each group: members[offsets[i]:offsets[i + 1]] (ascending ids)
+    membership = np.asarray(membership)
+    offsets = np.zeros(membership.max() + 2 if len(membership) else 1, dtype=np.int64)
+    np.cumsum(np.bincount(membership), out=offsets[1:])
+    members = np.argsort(membership, kind="stable")
+    return offsets, members
+
+
+def morton_codes(points, bits=10):
+    # Position along a Z-order curve through the bounding box of the points (bits per axis)
+    points = np.asarray(points, dtype=np.float64)
+    if not len(points):
+        return np.zeros(0, dtype=np.int64)
+    low = points.min(axis=0)
+    scale = (2**bits - 1) / np.maximum(points.max(axis=0) - low, 1e-12)
+    cells = ((points - low) * scale).astype(np.int64)
+
+    codes = np.zeros(len(points), dtype=np.int64)
+    for bit in range(bits):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return codes
 
-    num_clusters = max(clusters_membership) + 1
 
-    # Iterate over member_adjacencies to create dual graph clusters
-    for i, adjacent_indices in enumerate(member_adjacencies):
-        curr_cluster = clusters_membership[i]
-        for j in adjacent_indices:
-            adj_cluster = clusters_membership[j]
-            # Only add an edge if it is a border edge (clusters are different)
-            if curr_cluster != adj_cluster:
-                dual_graph_clusters[curr_cluster][adj_cluster] += 1
-                dual_graph_clusters[adj_cluster][curr_cluster] += 1
+def create_dual_graph_clusters(member_adjacencies, clusters_membership):
+    # Returns the weighted dual graph of the clusters in CSR form (xadj, adjncy, eweights)
+    # The weight of two neighboring clusters is the number of tri edges on their border
+    xadj, adjncy = member_adjacencies
+    clusters_membership = np.asarray(clusters_membership)
+    num_clusters = int(clusters_membership.max()) + 1
+
+    # Cluster of each tri and of each of its neighbors
+    curr_clusters = np.repeat(clusters_membership, np.diff(xadj))
+    adj_clusters = clusters_membership[adjncy]
+
+    # Only add an edge if it is a border edge (clusters are different)
+    border = curr_clusters != adj_clusters
+    pair_keys = curr_clusters[border].astype(np.int64) * num_clusters + adj_clusters[border]
+    pair_keys, eweights = np.unique(pair_keys, return_counts=True)
+
+    cluster_xadj = np.zeros(num_clusters + 1, dtype=np.int32)
+    np.cumsum(
+        np.bincount(pair_keys // num_clusters, minlength=num_clusters), out=cluster_xadj[1:]
+    )
+    cluster_adjncy = (pair_keys % num_clusters).astype(np.int32)
+    return cluster_xadj, cluster_adjncy, eweights.astype(np.int32)
 
-    dual_graph_clusters = [
-        tuple([(key, value) for key, value in dual_graph_clusters[i].items()])
-        for i in range(num_clusters)
-    ]
 
-    return dual_graph_clusters
+def metis_graph_kwargs(xadj, adjncy):
+    # Newer pymetis versions deprecate xadj/adjncy in favor of a CSRAdjacency object
+    if hasattr(pymetis, "CSRAdjacency"):
+        return {"adjacency": pymetis.CSRAdjacency(xadj, adjncy)}
+    return {"xadj": xadj, "adjncy": adjncy}
 
 
 def partition_graph(n_clusters, adjacencies):
-    n_cuts, membership = pymetis.part_graph(n_clusters, adjacencies)
+    # Adjacencies are either CSR arrays (xadj, adjncy) or adjacency lists
+    if isinstance(adjacencies, tuple):
+        xadj, adjncy = adjacencies
+        n_cuts, membership = pymetis.part_graph(n_clusters, **metis_graph_kwargs(xadj, adjncy))
+    else:
+        n_cuts, membership = pymetis.part_graph(n_clusters, adjacencies)
     return np.array(membership)
 
 def partition_graph_weighted(n_clusters, adjacencies):
-    # Convert the adjacency list to xadj, adjncy, and eweights
-    xadj = [0]
-    adjncy = []
-    eweights = []
-    for neighbors in adjacencies:
-        for neighbor, weight in neighbors:
-            adjncy.append(neighbor)
-            eweights.append(weight)
-        xadj.append(len(adjncy))
+    # Adjacencies are either CSR arrays (xadj, adjncy, eweights) or weighted adjacency lists
+    if isinstance(adjacencies, tuple):
+        xadj, adjncy, eweights = adjacencies
+    else:
+        # Convert the adjacency list to xadj, adjncy, and eweights
+        xadj = [0]
+        adjncy = []
+        eweights = []
+        for neighbors in adjacencies:
+            for neighbor, weight in neighbors:
+                adjncy.append(neighbor)
+                eweights.append(weight)
+            xadj.append(len(adjncy))
 
     n_cuts, membership = pymetis.part_graph(
         nparts=n_clusters,
-        xadj=xadj,
-        adjncy=adjncy,
-        eweights=eweights
+        eweights=eweights,
+        **metis_graph_kwargs(xadj, adjncy)
     )
     return np.array(membership)
 
@@ -197,7 +386,7 @@ def partition_graph_metis(n_clusters, adjacencies):
 
 def group_tris(tris, cluster_size):
     # Group tris based on graph partitioning (keep as many shared boundary edges as possible)
-    dual_adj = create_dual_graph(tris)
+    dual_adj = create_dual_graph_csr(tris)
     n_clusters = tris.shape[0] // cluster_size
     clusters = partition_graph(n_clusters, dual_adj)
     return dual_adj, clusters
@@ -255,6 +444,29 @@ def calc_RMS_error(verts1, verts2):
     return np.sqrt(error / len(verts1))
 
 
+def transfer_texture_coords(tree, texture_coords, verts, num_neighbors=2):
+    # Inverse distance weighted texture coords of the n closest vertices in tree
+    dists, indices = tree.query(verts, num_neighbors, workers=-1)
+    weights = 1 / (dists + 1e-8)  # Add a small epsilon to avoid division by zero
+    weights /= np.sum(weights, axis=1, keepdims=True)
+    return np.einsum('ij,ijk->ik', weights, texture_coords[indices])  # Magic einsum
+
+
+class RMSErrorIndex:
+    """Nearest neighbor index over the full mesh of a lod for geometric errors of simplified groups."""
+
+    def __init__(self, vertices):
+        self.tree = KDTree(vertices)
+
+    def rms_errors(self, group_vertices):
+        # RMS distance of each group's vertices to the mesh (single batched query)
+        lengths = np.array([len(verts) for verts in group_vertices])
+        dists, __ = self.tree.query(np.concatenate(group_vertices), workers=-1)
+        groups = np.repeat(np.arange(len(lengths)), lengths)
+        sums = np.bincount(groups, weights=np.square(dists), minlength=len(lengths))
+        return np.sqrt(sums / np.maximum(lengths, 1))
+
+
 def calc_bounding_sphere(vertices):
     center = np.mean(vertices, axis=0)
     radius = np.max(np.linalg.norm(vertices - center, axis=1))
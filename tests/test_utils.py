@@ -1,24 +1,44 @@
 ##
 #
-# python -m unittest discover -s tests
-# These tests are not working. Only useful as a starting point...
+# python -m pytest tests (or python -m unittest discover -s tests)
 #
 ##
 
 
 import unittest
 import os
+import subprocess
+import sys
+import tempfile
 
 import numpy as np
+from scipy.spatial import KDTree
 
 # Set the METIS_DLL environment variable to the current path
 current_path = os.path.abspath(os.path.dirname(__file__))
 parent_path = os.path.abspath(os.path.join(current_path, os.pardir))
 os.environ["METIS_DLL"] = os.path.join(parent_path, "libmetis.so")
 
-from LODtris.utils import group_tris, simplify_mesh_inside, create_dual_graph
+from pynanite.utils import (
+    group_tris, simplify_mesh_inside, create_dual_graph, create_dual_graph_csr,
+    create_dual_graph_clusters, group_members, load_obj, parse_obj, transfer_texture_coords,
+    RMSErrorIndex, calc_RMS_error
+)
 
-from LODtris.lod_graph import next_lod, combine_group_lods
+from pynanite.bake_cache import BakeCache
+from pynanite.residency import ResidencyManager
+from pynanite.allocator import RangeAllocator
+from pynanite.lod_scheduler import LODUpdateScheduler
+from pynanite.scene import SceneGrid
+from pynanite.camera import Camera
+from pynanite.cut_selector import CutSelector, AsyncCutSelector
+from pynanite.baked_model import (
+    read_baked_model, write_baked_model, quantize_attributes, dequantize_attributes
+)
+from pynanite.lod_graph import (
+    next_lod, combine_group_lods, build_cluster_dag, build_cut_groups, save_checkpoint,
+    load_checkpoint, lod0_tree, LOD0_TREE_CACHE_SIZE, LODGraph
+)
 
 def create_grid_mesh_tris(size=(256, 256)):
     vertices = []
@@ -45,10 +65,31 @@ def create_grid_mesh_tris(size=(256, 256)):
     return vertices, tris, adjacencies
 
 
+def create_torus_mesh_tris(size=(64, 32), radii=(1.0, 0.4)):
+    # Closed mesh: Can be simplified down to a single cluster
+    u, v = np.meshgrid(
+        np.linspace(0, 2 * np.pi, size[0], endpoint=False),
+        np.linspace(0, 2 * np.pi, size[1], endpoint=False),
+    )
+    ring = radii[0] + radii[1] * np.cos(v)
+    vertices = np.stack([ring * np.cos(u), radii[1] * np.sin(v), ring * np.sin(u)], axis=-1)
+    vertices = vertices.reshape(-1, 3).astype(np.float32)
+
+    ids = np.arange(size[0] * size[1]).reshape(size[1], size[0])
+    right = np.roll(ids, -1, axis=1)
+    up = np.roll(ids, -1, axis=0)
+    up_right = np.roll(right, -1, axis=0)
+    tris = np.concatenate([
+        np.stack([ids, up, right], axis=-1).reshape(-1, 3),
+        np.stack([right, up, up_right], axis=-1).reshape(-1, 3),
+    ])
+    return vertices, tris
+
+
 class TestSimplifyMesh(unittest.TestCase):
     def test_preserved_borders(self):
         vertices, tris, __ = create_grid_mesh_tris()
-        v_simple, t_simple = simplify_mesh_inside(vertices, tris, removal_ratio=0.5)
+        v_simple, t_simple, __ = simplify_mesh_inside(vertices, tris, removal_ratio=0.5)
         self.assertTrue(len(t_simple) < len(tris) * 0.55)
 
         border_vertices = []
@@ -67,43 +108,462 @@ class TestSimplifyMesh(unittest.TestCase):
 
 class TestCombineLods(unittest.TestCase):
     def test_combine_lods(self):
-        vertices, tris, adj = create_grid_mesh_tris()
+        vertices, tris, __ = create_grid_mesh_tris(size=(32, 32))
+        normals = np.zeros_like(vertices)
+        adjacencies = create_dual_graph_csr(tris)
 
-        clusters = np.zeros(len(tris), dtype=np.uint32)
+        clusters = np.zeros(len(tris), dtype=np.int64)
         clusters[0:1000] = 1
-        lod0 = (vertices, tris, adj, clusters)
-
-        lod_comb = combine_group_lods([lod0], clusters)
-        assert np.array_equal(lod_comb[0], vertices)
-        assert np.array_equal(lod_comb[1], tris)
-        assert np.array_equal(lod_comb[3], clusters)
+        lod0 = (vertices, tris, adjacencies, clusters, 0.1, normals)
 
         vertices_shifted = vertices.copy()
         vertices_shifted[:, 2] += 10
-        lod1 = (vertices_shifted, tris, adj, clusters)
+        lod1 = (vertices_shifted, tris, adjacencies, clusters, 0.2, normals)
+
+        # Two groups of two clusters each, no shared vertices
+        lod_comb = combine_group_lods([lod0, lod1], [[0, 1], [2, 3]])
+        new_vertices, new_tris, (xadj, adjncy), new_clusters, graph_adjacencies, errors, __ = lod_comb
+
+        self.assertTrue(np.array_equal(new_vertices, np.concatenate([vertices, vertices_shifted])))
+        self.assertTrue(np.array_equal(new_tris, np.concatenate([tris, tris + len(vertices)])))
+        self.assertTrue(np.array_equal(new_clusters, np.concatenate([clusters, clusters + 2])))
+        self.assertEqual([list(adjs) for adjs in graph_adjacencies], [[0, 1], [0, 1], [2, 3], [2, 3]])
+        self.assertEqual(errors, [0.1, 0.1, 0.2, 0.2])
+
+        # Dual graph of the combined mesh: Two disconnected copies
+        self.assertEqual(len(xadj), 2 * len(tris) + 1)
+        self.assertTrue(np.array_equal(adjncy, np.concatenate([adjacencies[1], adjacencies[1] + len(tris)])))
+
+    def test_weld_shared_vertices(self):
+        # Two groups (one cluster each) sharing the edge (1, 0, 0) - (0, 1, 0)
+        normals = np.array([[0, 0, 1]] * 3, dtype=np.float64)
+        lod0 = (
+            np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=np.float64),
+            np.array([[0, 1, 2]]), None, np.zeros(1, dtype=int), 0.1, normals
+        )
+        lod1 = (
+            np.array([[0, 1, 0], [1, 0, 0], [1, 1, 0]], dtype=np.float64),
+            np.array([[1, 2, 0]]), None, np.zeros(1, dtype=int), 0.2, -normals
+        )
+
+        lod_comb = combine_group_lods([lod0, lod1], [[0], [1]])
+        vertices, tris, (xadj, adjncy), clusters, graph_adjacencies, errors, new_normals = lod_comb
+
+        self.assertTrue(np.array_equal(vertices, [[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0]]))
+        self.assertTrue(np.array_equal(tris, [[0, 1, 2], [1, 3, 2]]))
+        self.assertTrue(np.array_equal(new_normals[:, 2], [1, 1, 1, -1]))
+        self.assertEqual(list(adjncy), [1, 0])
+        self.assertEqual(list(clusters), [0, 1])
+        self.assertEqual(errors, [0.1, 0.2])
+
+
+class TestLoadObj(unittest.TestCase):
+    OBJ = (
+        b"# quad and tri with v/t/n corners\n"
+        b"v 0 0 0\nv 2 0 0\nv 2 2 0\nv 0 2 0\nv 0 0 2\n"
+        b"vt 0 0\nvt 1 0\nvt 1 1\nvt 0 1\n"
+        b"vn 0 0 1\nvn 0 1 0\n"
+        b"s 1\n"
+        b"f 1/1/1 2/2/1 3/3/1 4/4/1\n"
+        b"f -5/1/2 -4/2/2 -1/4/2"
+    )
+
+    def test_parse_obj(self):
+        vertices, tris, texture_coords, normals = parse_obj(self.OBJ)
+
+        self.assertEqual(vertices.shape, (5, 3))
+        self.assertEqual(vertices.max(), 1)
+        self.assertTrue(np.array_equal(tris, [[0, 1, 2], [0, 2, 3], [0, 1, 4]]))
+        self.assertTrue(np.array_equal(texture_coords[[2, 4]], [[1, 1], [0, 1]]))
+        self.assertTrue(np.array_equal(normals[[2, 4]], [[0, 0, 1], [0, 1, 0]]))
+
+    def test_parse_obj_vertices_only(self):
+        vertices, tris, texture_coords, normals = parse_obj(
+            b"v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3\nf 1 3 4\n"
+        )
+        self.assertTrue(np.array_equal(tris, [[0, 1, 2], [0, 2, 3]]))
+        self.assertEqual(texture_coords.shape, (4, 2))
+        self.assertEqual(normals.shape, (4, 3))
+
+    def test_parse_obj_mixed_corner_formats(self):
+        vertices, tris, texture_coords, normals = parse_obj(
+            b"v 0 0 0\nv 1 0 0\nv 0 1 0\nv 1 1 0\nvt 0 0\nvt 1 0\nvt 0 1\nvn 0 0 1\nvn 0 1 0\n"
+            b"f 1/1/1 2/2/1 3/3/1\nf 2//2 4//2 3//2\n"
+        )
+        self.assertTrue(np.array_equal(tris, [[0, 1, 2], [1, 3, 2]]))
+        self.assertTrue(np.array_equal(normals[:, 1], [0, 1, 1, 1]))
+
+    def test_parse_obj_relative_indices(self):
+        vertices, tris, __, __ = parse_obj(
+            b"v 0 0 0\nv 1 0 0\nv 0 1 0\nf -3 -2 -1\nv 0 0 1\nv 1 0 1\nv 0 1 1\nf -3 -2 -1\n"
+        )
+        self.assertTrue(np.array_equal(tris, [[0, 1, 2], [3, 4, 5]]))
+
+    def test_parse_obj_without_faces(self):
+        vertices, tris, __, __ = parse_obj(b"v 0 0 0\nv 1 0 0\nv 0 1 0\n")
+        self.assertEqual(len(vertices), 3)
+        self.assertEqual(tris.shape, (0, 3))
+
+    def test_load_obj_broken_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mesh.obj")
+            with open(path, "wb") as f:
+                f.write(self.OBJ)
+            with open(path + ".npz", "wb") as f:
+                f.write(b"PK\x03\x04 truncated")
+
+            vertices, tris, __, __ = load_obj(path)
+            self.assertEqual(len(tris), 3)
+            self.assertEqual(len(load_obj(path)[1]), 3)
+
+    def test_load_obj_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mesh.obj")
+            with open(path, "wb") as f:
+                f.write(self.OBJ)
+
+            parsed = load_obj(path)
+            self.assertTrue(os.path.exists(path + ".npz"))
+
+            cached = load_obj(path)
+            for a, b in zip(parsed, cached):
+                self.assertTrue(np.array_equal(a, b))
+
+
+class TestDualGraph(unittest.TestCase):
+    def test_csr_matches_lists(self):
+        vertices, tris, adjacencies = create_grid_mesh_tris(size=(32, 32))
+        xadj, adjncy = create_dual_graph_csr(tris)
+
+        self.assertEqual(len(xadj), len(tris) + 1)
+        self.assertEqual(adjncy.dtype, np.int32)
+        for i, adj in enumerate(adjacencies):
+            self.assertEqual(sorted(adj), list(adjncy[xadj[i]:xadj[i + 1]]))
+
+    def test_csr_non_manifold(self):
+        tris = np.array([[0, 1, 2], [1, 0, 3], [0, 1, 4], [4, 5, 6]])
+        xadj, adjncy = create_dual_graph_csr(tris)
+
+        self.assertEqual(list(xadj), [0, 2, 4, 6, 6])
+        self.assertEqual(list(adjncy), [1, 2, 0, 2, 0, 1])
+
+    def test_csr_empty(self):
+        xadj, adjncy = create_dual_graph_csr(np.array([]))
+        self.assertEqual(list(xadj), [0])
+        self.assertEqual(len(adjncy), 0)
+
+    def test_cluster_graph(self):
+        # Strip of 4 tris: 0 - 1 - 2 - 3, clusters [0, 0, 1, 2]
+        tris = np.array([[0, 1, 2], [1, 3, 2], [2, 3, 4], [3, 5, 4]])
+        clusters = np.array([0, 0, 1, 2])
+        xadj, adjncy, eweights = create_dual_graph_clusters(create_dual_graph_csr(tris), clusters)
+
+        self.assertEqual(list(xadj), [0, 1, 3, 4])
+        self.assertEqual(list(adjncy), [1, 0, 2, 1])
+        self.assertEqual(list(eweights), [1, 1, 1, 1])
+
+
+class TestGroupMembers(unittest.TestCase):
+    def test_group_members(self):
+        offsets, members = group_members(np.array([2, 0, 2, 0, 3]))
+        self.assertEqual(list(offsets), [0, 2, 2, 4, 5])
+        self.assertEqual(list(members), [1, 3, 0, 2, 4])
+
+
+class TestTexturing(unittest.TestCase):
+    def test_transfer_texture_coords(self):
+        vertices = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=np.float32)
+        texture_coords = np.array([[0, 0], [1, 0], [0, 1]], dtype=np.float32)
+        verts = np.array([[0, 0, 0], [0.5, 0, 0], [0, 0.75, 0]])
+
+        result = transfer_texture_coords(KDTree(vertices), texture_coords, verts)
+        self.assertTrue(np.allclose(result, [[0, 0], [0.5, 0], [0, 0.75]], atol=1e-6))
+
+    def test_lod0_tree_cache(self):
+        vertices = np.random.default_rng(0).random((100, 3))
+        tree = lod0_tree(vertices)
+        self.assertIs(lod0_tree(vertices.copy()), tree)
+
+        # Only the most recently used trees are kept
+        for i in range(LOD0_TREE_CACHE_SIZE):
+            lod0_tree(vertices + i + 1)
+        self.assertIsNot(lod0_tree(vertices), tree)
+
+
+class TestRMSErrorIndex(unittest.TestCase):
+    def test_matches_calc_RMS_error(self):
+        vertices, __, __ = create_grid_mesh_tris()
+        groups = [vertices[:50] + 0.01, vertices[100:130] * 1.1, vertices[:0]]
+
+        errors = RMSErrorIndex(vertices).rms_errors(groups)
+        self.assertEqual(len(errors), 3)
+        for group, error in zip(groups[:2], errors):
+            self.assertAlmostEqual(error, calc_RMS_error(group, vertices))
+        self.assertEqual(errors[2], 0)
+
+
+class TestBakeCache(unittest.TestCase):
+    def test_key_and_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            obj_path = os.path.join(directory, "mesh.obj")
+            with open(obj_path, "w") as f:
+                f.write("v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n")
+
+            cache = BakeCache(os.path.join(directory, "cache"), max_bytes=1000)
+            config = {"cluster_size_initial": 160, "cluster_size": 128, "group_size": 8}
+            key = cache.key([obj_path], config)
+            self.assertEqual(key, cache.key([obj_path], dict(config)))
+            self.assertNotEqual(key, cache.key([obj_path], dict(config, group_size=4)))
+            self.assertIsNone(cache.get(key))
+
+            # Memoized hashes survive a new cache instance, changed sources change the key
+            self.assertEqual(key, BakeCache(cache.directory).key([obj_path], config))
+            with open(obj_path, "a") as f:
+                f.write("f 3 2 1\n")
+            self.assertNotEqual(key, cache.key([obj_path], config))
+
+            build_path = os.path.join(directory, "mesh.bake")
+            for i in range(3):
+                with open(build_path, "wb") as f:
+                    f.write(bytes([i]) * 400)
+                cache.put("key%d" % i, build_path)
+                os.utime(cache.entry_path("key%d" % i), (i, i))
+
+            # Least recently used entry was evicted
+            self.assertIsNone(cache.get("key0"))
+            with open(cache.get("key2"), "rb") as f:
+                self.assertEqual(f.read(), bytes([2]) * 400)
+
+
+class TestBakedModel(unittest.TestCase):
+    def test_roundtrip(self):
+        arrays = {
+            "verts": np.random.rand(100, 3).astype(np.float32),
+            "offsets": np.array([0, 0, 40, 100], dtype=np.int32),
+            "errors": np.random.rand(3),
+            "empty": np.zeros((0, 2), dtype=np.float32),
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "model.bake")
+            write_baked_model(path, arrays, {"paths": ["a.obj", "a.jpg", path]})
+            loaded, meta = read_baked_model(path)
+
+            self.assertEqual(meta["paths"][2], path)
+            for name, array in arrays.items():
+                self.assertEqual(loaded[name].dtype, array.dtype)
+                self.assertTrue(np.array_equal(loaded[name], array))
+                self.assertEqual(loaded[name].ctypes.data % 64, 0)
+                self.assertFalse(loaded[name].flags.writeable)
+            del loaded
+
+            # Not a baked model (e.g. an old pickle)
+            with open(path, "wb") as f:
+                f.write(b"\x80\x04 pickle")
+            with self.assertRaises(ValueError):
+                read_baked_model(path)
+
+    def test_quantization(self):
+        vertex_offsets = np.array([0, 0, 300, 1000])
+        centers = np.array([[0, 0, 0], [0.2, 0.2, 0.2], [0.5, 0.5, 0.5]])
+        radii = np.array([0, 0.1, 0.5])
+        directions = np.random.randn(1000, 3)
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        cluster_ids = np.repeat(np.arange(3), np.diff(vertex_offsets))
+        verts = centers[cluster_ids] + directions * radii[cluster_ids, None]
+        normals = np.random.randn(1000, 3)
+        normals /= np.linalg.norm(normals, axis=1)[:, None]
+        textures = np.random.rand(1000, 2) * 3 - 1
+
+        arrays, meta = quantize_attributes(vertex_offsets, verts, normals, textures, centers, radii, 1e-5)
+        self.assertEqual(arrays["verts"].dtype, np.uint16)
+        self.assertEqual(arrays["normals"].dtype, np.int16)
+        self.assertEqual(arrays["textures"].dtype, np.uint16)
+
+        decoded_verts, decoded_normals, decoded_textures = dequantize_attributes(
+            vertex_offsets, arrays, centers, radii, meta
+        )
+        self.assertLessEqual(np.abs(decoded_verts - verts).max(), 1e-5)
+        self.assertGreater((decoded_normals * normals).sum(axis=1).min(), 0.99999)
+        self.assertLessEqual(np.abs(decoded_textures - textures).max(), 1e-4)
+
+        # Error bound too small for 16 bits
+        self.assertIsNone(quantize_attributes(vertex_offsets, verts, normals, textures, centers, radii, 1e-6))
+
+
+class TestResidencyManager(unittest.TestCase):
+    class Graph:
+        def load_cluster(self, cluster):
+            return (np.full(100, cluster, dtype=np.uint8),)
+
+    def test_lru_budget(self):
+        graph = self.Graph()
+        residency = ResidencyManager(budget_bytes=300)
+        try:
+            self.assertIsNone(residency.get(graph, 1))
+            self.assertEqual(residency.get(graph, 1, wait=True)[0][0], 1)
+            residency.retain(graph, [1])
+
+            for cluster in [2, 3, 4]:
+                residency.get(graph, cluster, wait=True)
+            self.assertFalse(residency.ready(graph, [5]))
+            residency.executor.submit(lambda: None).result()  # Wait for the load of cluster 5
+            residency.update()
+
+            # Least recently used unretained clusters are evicted first
+            self.assertEqual(residency.resident_bytes, 300)
+            self.assertEqual(set(key[1] for key in residency.resident), {1, 4, 5})
+            self.assertTrue(residency.ready(graph, [1, 5]))
+
+            # Released clusters can be evicted
+            residency.release(graph, [1])
+            residency.get(graph, 6, wait=True)
+            residency.budget_bytes = 100
+            residency.evict()
+            self.assertEqual(set(key[1] for key in residency.resident), {6})
+        finally:
+            residency.shutdown()
 
-        lod_comb = combine_group_lods([lod0, lod1], clusters)
 
-        self.assertIsInstance(lod_comb, tuple)
-        self.assertEqual(len(lod_comb), 4)
-        self.assertIsInstance(lod_comb[0], np.ndarray)
-        self.assertIsInstance(lod_comb[1], np.ndarray)
-        self.assertIsInstance(lod_comb[2], list)
-        self.assertIsInstance(lod_comb[2][0], list)
-        self.assertIsInstance(lod_comb[3], np.ndarray)
+class TestRangeAllocator(unittest.TestCase):
+    def test_allocate_free(self):
+        allocator = RangeAllocator(100)
+        starts = [allocator.allocate(size) for size in [10, 20, 30, 40]]
+        self.assertEqual(starts, [0, 10, 30, 60])
+        self.assertIsNone(allocator.allocate(1))
 
-        assert np.array_equal(lod_comb[0], np.concatenate([vertices, vertices_shifted]))
-        self.assertEqual(len(lod_comb[1]), len(tris) * 2)
-        self.assertEqual(len(lod_comb[3]), len(clusters) * 2)
+        # Freed ranges are reused first fit, neighbours are merged
+        allocator.free(10, 20)
+        allocator.free(60, 40)
+        self.assertAlmostEqual(allocator.fragmentation(), 0.2)
+        self.assertEqual(allocator.allocate(15), 10)
+        allocator.free(0, 10)
+        allocator.free(30, 30)
+        self.assertEqual(allocator.free_starts, [0, 25])
+        self.assertEqual(allocator.free_sizes, {0: 10, 25: 75})
+        allocator.free(10, 15)
+        self.assertEqual(allocator.free_sizes, {0: 100})
+        self.assertEqual((allocator.used, allocator.fragmentation()), (0, 0))
 
-        n_vert = len(adj)
 
-        exp_adj = [[v + n_vert for v in tri] for tri in adj]
-        adj += exp_adj
+class TestLODUpdateScheduler(unittest.TestCase):
+    def test_budget(self):
+        class Mesh:
+            def __init__(self, resident=True):
+                self.clusters = {1}
+                self.cluster_mesh = self
+                self.resident = resident
 
-        for i, v in enumerate(lod_comb[2]):
-            if not np.array_equal(v, adj[i]):
-                raise Exception("Adjacency mismatch:", i, v, adj[i])
+            def is_resident(self, clusters):
+                return self.resident
+
+            def upload_bytes(self, clusters):
+                return 100 * len(clusters - self.clusters)
+
+            def set_clusters(self, clusters, prepared=None):
+                self.clusters = clusters
+
+            def show_root_if_culled(self):
+                if not self.clusters:
+                    self.clusters = {1}
+
+        meshes = [Mesh(), Mesh(), Mesh(), Mesh(resident=False)]
+        scheduler = LODUpdateScheduler(time_budget=None, byte_budget=250)
+        scheduler.submit([
+            (meshes[0], {2, 3}, 0.5, None),
+            (meshes[1], {4, 5}, 2.0, None),
+            (meshes[2], {1}, 3.0, None),  # Unchanged
+            (meshes[3], {6}, 5.0, None),  # Still loading
+        ])
+        self.assertEqual(len(scheduler.pending), 3)
+
+        # Highest priority first, the rest waits for the next frame
+        self.assertEqual(scheduler.update(), 1)
+        self.assertEqual(meshes[1].clusters, {4, 5})
+        self.assertEqual(meshes[0].clusters, {1})
+
+        # A newer cut replaces the pending one, at least one cut is applied per frame
+        scheduler.submit([(meshes[0], {7, 8, 9}, 0.5, None)])
+        self.assertEqual(scheduler.update(), 1)
+        self.assertEqual(meshes[0].clusters, {7, 8, 9})
+        self.assertEqual(list(scheduler.pending), [meshes[3]])
+
+        # Culled before and the new cut is still loading: The root is drawn meanwhile
+        meshes[3].clusters = set()
+        scheduler.update()
+        self.assertEqual(meshes[3].clusters, {1})
+
+
+class TestCamera(unittest.TestCase):
+    def test_frustum_culling(self):
+        camera = Camera(45, 2.0, 0.1, 200.0)
+        forward = camera.forward
+        side = np.cross(forward, [0, 1, 0])
+        side /= np.linalg.norm(side)
+        half_width = 10 * np.tan(np.radians(22.5)) * 2.0  # At a distance of 10
+
+        centers = camera.position + np.array([
+            10 * forward,  # Center
+            -10 * forward,  # Behind
+            250 * forward,  # Beyond the far plane
+            199.5 * forward,
+            10 * forward + (half_width + 0.5) * side,  # Right of the horizontal fov
+            10 * forward + (half_width + 0.5) * side,
+            0.05 * forward,  # Before the near plane
+        ])
+        radii = np.array([0.1, 1, 1, 1, 0.1, 1, 0.01])
+        expected = [True, False, False, True, False, True, False]
+        self.assertEqual(camera.check_spheres_in_frustum(centers, radii).tolist(), expected)
+        self.assertEqual(camera.check_spheres_in_frustum(centers[None], radii[None]).shape, (1, 7))
+
+
+class TestSceneGrid(unittest.TestCase):
+    def test_query(self):
+        class Graph:
+            cluster_bounding_centers = np.array([[0.0, 0, 0], [0.5, 0.5, 0]])
+            cluster_bounding_radii = np.array([0.5, 1.0])
+
+        class Mesh:
+            lod_dag = Graph
+
+            def __init__(self, position):
+                self.position = position
+
+        rng = np.random.default_rng(0)
+        positions = rng.uniform(-300, 300, (2000, 3))
+        camera = Camera()
+        scene = SceneGrid(cell_size=20)
+        meshes = []
+        for position in positions[:1000]:
+            meshes.append(Mesh(position))
+            scene.insert(meshes[-1])
+        scene.query(camera)
+        for position in positions[1000:]:  # After a query
+            meshes.append(Mesh(position))
+            scene.insert(meshes[-1])
+        self.assertEqual(len(scene.take_inserted()), 2000)
+        self.assertEqual(scene.take_inserted(), [])
+
+        centers = positions + Graph.cluster_bounding_centers[-1]
+        for max_distance in [None, 150]:
+            expected = camera.check_spheres_in_frustum(centers, np.ones(len(centers)))
+            if max_distance is not None:
+                expected &= np.linalg.norm(centers - camera.position, axis=1) - 1 <= max_distance
+            visible = scene.query(camera, max_distance)
+            self.assertGreater(len(visible), 0)
+            self.assertEqual(
+                sorted(id(mesh) for mesh in visible),
+                sorted(id(mesh) for mesh, inside in zip(meshes, expected) if inside)
+            )
+
+
+class TestHeadless(unittest.TestCase):
+    def test_no_opengl_imports(self):
+        # Baking must work without a display (no OpenGL imports)
+        code = "import sys, pynanite.bake, pynanite.lod_graph; print('OpenGL' in sys.modules)"
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, cwd=parent_path, check=True
+        )
+        self.assertEqual(result.stdout.strip(), "False")
 
 
 class TestLOD(unittest.TestCase):
@@ -120,12 +580,251 @@ class TestLOD(unittest.TestCase):
         lods = [[vertices, tris, adjacencies, clusters, [], [], []]]
         num_clusters = max(clusters) + 1
         while num_clusters > 20:
-            lods.append(next_lod(lods[-1], config, parallel=False))
+            lods.append(next_lod(lods[-1], config, num_workers=1))
             num_clusters = max(lods[-1][3]) + 1
         print(
             f"Finished simplification, created {len(lods)} LODs. {num_clusters} clusters remaining."
         )
 
+    def test_bake_stalls(self):
+        # Open mesh: Preserved borders stop the simplification before a single cluster remains
+        vertices, tris, __ = create_grid_mesh_tris(size=(64, 64))
+        with tempfile.TemporaryDirectory() as directory:
+            obj_path = os.path.join(directory, "grid.obj")
+            with open(obj_path, "w") as f:
+                f.writelines("v %f %f %f\n" % tuple(vertex) for vertex in vertices)
+                f.writelines("f %d %d %d\n" % tuple(tri + 1) for tri in tris)
+
+            with self.assertRaises(RuntimeError):
+                LODGraph((obj_path, None, os.path.join(directory, "grid")), force_build=True)
+
+    def test_checkpoint(self):
+        config = {"cluster_size_initial": 160, "cluster_size": 128, "group_size": 8}
+        vertices, tris = create_torus_mesh_tris()
+        adjacencies, clusters = group_tris(tris, 160)
+        lods = [[vertices, tris, adjacencies, clusters, [np.arange(clusters.max() + 1)], [0], vertices]]
+        lods.append(next_lod(lods[-1], config))
+        key = {"obj": [1, 2], "config": config}
+
+        with tempfile.TemporaryDirectory() as directory:
+            directory = os.path.join(directory, "bake.checkpoint")
+            for level, lod in enumerate(lods):
+                save_checkpoint(directory, key, level, lod)
+
+            loaded = load_checkpoint(directory, key)
+            self.assertEqual(len(loaded), 2)
+            for lod, loaded_lod in zip(lods, loaded):
+                for i in [0, 1, 3, 6]:
+                    self.assertTrue(np.array_equal(lod[i], loaded_lod[i]))
+                self.assertTrue(np.array_equal(lod[2][1], loaded_lod[2][1]))
+                self.assertEqual(len(lod[4]), len(loaded_lod[4]))
+                for adjs, loaded_adjs in zip(lod[4], loaded_lod[4]):
+                    self.assertTrue(np.array_equal(adjs, loaded_adjs))
+                self.assertTrue(np.allclose(lod[5], loaded_lod[5]))
+
+            # Different input or config: No checkpoint
+            self.assertEqual(load_checkpoint(directory, {"obj": [1, 3], "config": config}), [])
+
+            # A new bake replaces the old checkpoint
+            save_checkpoint(directory, {"obj": [1, 3], "config": config}, 0, lods[0])
+            self.assertEqual(len(load_checkpoint(directory, {"obj": [1, 3], "config": config})), 1)
+
+    def test_cluster_dag(self):
+        config = {
+            "cluster_size_initial": 160,
+            "cluster_size": 128,
+            "group_size": 8
+        }
+
+        vertices, tris = create_torus_mesh_tris()
+        adjacencies, clusters = group_tris(tris, cluster_size=config["cluster_size_initial"])
+        normals = np.zeros_like(vertices)
+        lods = [[vertices, tris, adjacencies, clusters, [np.arange(clusters.max() + 1)], [0], normals]]
+        while lods[-1][3].max() > 0:
+            lods.append(next_lod(lods[-1], config))
+
+        dag, dag_rev, verts, indices, __, errors, centers, radii = build_cluster_dag(lods)
+        num_clusters = 1 + sum(lod[3].max() + 1 for lod in lods)
+        self.assertEqual(len(dag), num_clusters)
+        self.assertEqual(len(dag[-1]), 0)
+        self.assertEqual(sum(len(i) for i in indices), 3 * sum(len(lod[1]) for lod in lods))
+
+        # Indexed clusters reproduce the tris of each lod
+        cluster_id = 1
+        for vertices, tris, __, clusters, __, __, __ in lods:
+            for cluster in range(clusters.max() + 1):
+                local_verts, local_indices = verts[cluster_id], indices[cluster_id]
+                self.assertEqual(local_indices.max() + 1, len(local_verts))
+                self.assertTrue(np.all(np.diff(np.maximum.accumulate(local_indices)) <= 1))  # First use
+                expected = np.sort(np.sort(vertices[tris[clusters == cluster]], axis=1), axis=0)
+                result = np.sort(np.sort(local_verts[local_indices.reshape(-1, 3)], axis=1), axis=0)
+                self.assertTrue(np.allclose(expected, result))
+                cluster_id += 1
+
+        for i in range(1, num_clusters):
+            for j in dag_rev[i]:
+                self.assertIn(i, dag[j])
+                if j == 0:
+                    continue
+                self.assertGreater(errors[i], errors[j])
+                dist = np.linalg.norm(centers[i] - centers[j])
+                self.assertLessEqual(dist + radii[j], radii[i] + 1e-6)
+
+    def test_cut_selection(self):
+        config = {
+            "cluster_size_initial": 160,
+            "cluster_size": 128,
+            "group_size": 8
+        }
+
+        vertices, tris = create_torus_mesh_tris()
+        adjacencies, clusters = group_tris(tris, cluster_size=config["cluster_size_initial"])
+        normals = np.zeros_like(vertices)
+        lods = [[vertices, tris, adjacencies, clusters, [np.arange(clusters.max() + 1)], [0], normals]]
+        while lods[-1][3].max() > 0:
+            lods.append(next_lod(lods[-1], config))
+
+        dag, dag_rev, __, __, __, errors, centers, radii = build_cluster_dag(lods)
+        dag_offsets = np.concatenate([[0], np.cumsum([len(p) for p in dag])])
+        rev_offsets = np.concatenate([[0], np.cumsum([len(k) for k in dag_rev])])
+
+        class Graph:
+            cut_groups = build_cut_groups(
+                dag_offsets, np.concatenate(dag).astype(int), rev_offsets,
+                np.concatenate(dag_rev).astype(int), errors, centers, radii
+            )
+            cluster_bounding_centers = centers
+            cluster_bounding_radii = radii
+
+        class NoCulling(Camera):
+            def check_spheres_in_frustum(self, centers, radii):
+                return np.ones(np.broadcast_shapes(np.shape(centers)[:-1], np.shape(radii)), dtype=bool)
+
+        positions = np.array([[0, 0, 0], [0, 0, 2], [5, 0, 5], [0, 3, -4], [-100, 0, 0], [0, 0, 10000]])
+        unculled = CutSelector(NoCulling()).select(Graph, positions)
+        self.assertEqual(unculled.shape, (len(positions), len(dag)))
+
+        # Every path from LOD 0 to the root contains exactly one drawn cluster
+        for instance in unculled:
+            self.assertFalse(instance[0])
+            for cluster in dag[0]:
+                num_drawn = 0
+                while True:
+                    num_drawn += instance[cluster]
+                    if len(dag[cluster]) == 0:
+                        break
+                    cluster = dag[cluster][0]
+                self.assertEqual(num_drawn, 1)
+
+        # Far away: Root only. Camera inside: Detailed
+        self.assertEqual(np.flatnonzero(unculled[-1]).tolist(), [len(dag) - 1])
+        self.assertEqual(np.flatnonzero(unculled[3]).tolist(), sorted(dag[0]))
+
+        # Priority of a cut: Missing detail first (near instances first), then unnecessary detail
+        selector = CutSelector(NoCulling(), threshold=0.001)
+        values = selector._select(Graph, np.array([[0, 0, 2], [0, 0, 20], [0, 0, 50]]), selector.camera)[0]
+        group_of, child_group = Graph.cut_groups[:2]
+        root, lod0 = [len(dag) - 1], sorted(dag[0])
+        near_refine = selector.cut_priority(values[0], group_of[root], child_group[root])
+        far_refine = selector.cut_priority(values[1], group_of[root], child_group[root])
+        coarsen = selector.cut_priority(values[2], group_of[lod0], child_group[lod0])
+        self.assertGreater(near_refine, far_refine)
+        self.assertGreater(far_refine, 1)
+        self.assertTrue(0 < coarsen < 1)
+
+        # Culling removes clusters from the cut, instances behind the camera or beyond the far plane
+        camera = Camera()
+        draw = CutSelector(camera).select(Graph, positions)
+        self.assertFalse(np.any(draw & ~unculled))
+        self.assertEqual(draw[-1].sum() + draw[-2].sum(), 0)
+        self.assertTrue(0 < draw[3].sum() < unculled[3].sum())
+
+        # On a worker thread: The render thread swaps in the cuts of the latest camera
+        class Mesh:
+            lod_dag = Graph
+
+            def __init__(self, position):
+                self.position = position
+                self.cluster_mesh = self
+
+            def is_resident(self, clusters):
+                return True
+
+            def prepare(self, cluster_array):
+                return cluster_array, None
+
+            def set_clusters(self, clusters, prepared=None):
+                self.clusters = clusters
+                if prepared is not None:
+                    self.cluster_array = prepared[0]
+
+        # Unnecessary detail: Far instances (root only, no per group work) first
+        selector = CutSelector(NoCulling(), threshold=0.001)
+        meshes = [Mesh(position) for position in [[-100, 0, 0], [0, 0, 300], [0, 0, 10000]]]
+        for mesh in meshes:
+            mesh.set_clusters(set(lod0))
+        cuts = selector.select_cuts(selector.camera, meshes)
+        self.assertEqual([cut[1] for cut in cuts], [set(root)] * 3)
+        self.assertTrue(coarsen < cuts[0][2] < cuts[1][2] < cuts[2][2] < 1)
+
+        meshes = [Mesh(position) for position in positions]
+        for mesh in meshes:
+            mesh.set_clusters({len(dag) - 1})
+        selector = AsyncCutSelector(camera)
+        try:
+            for camera.position in [np.array([5.0, 0, 5]), np.array([0, 3.0, -4])]:
+                selector.update(meshes)
+            selector.wait()
+            selector.update(meshes)
+        finally:
+            selector.shutdown()
+        for mesh, instance in zip(meshes, draw):
+            self.assertEqual(mesh.clusters, set(np.flatnonzero(instance).tolist()))
+            if mesh.clusters:
+                self.assertEqual(mesh.cluster_array.tolist(), sorted(mesh.clusters))  # Prepared by the worker
+
+        # Instances of a scene: Only visible ones (within max_distance) are selected, others get empty cuts
+        distances = np.linalg.norm(centers[-1] + positions - camera.position, axis=1) - radii[-1]
+        within = distances <= 5
+        self.assertTrue(0 < (draw.any(axis=1) & within).sum() < draw.any(axis=1).sum())
+        meshes = [Mesh(position) for position in positions]
+        for selector, inside in [
+            (CutSelector(camera), np.ones(len(positions), dtype=bool)),
+            (AsyncCutSelector(camera), np.ones(len(positions), dtype=bool)),
+            (AsyncCutSelector(camera, max_distance=5), within),
+        ]:
+            scene = SceneGrid()
+            for mesh in meshes:
+                mesh.set_clusters({len(dag) - 1})
+                scene.insert(mesh)
+            try:
+                selector.update(scene)
+                if isinstance(selector, AsyncCutSelector):
+                    selector.wait()
+                    selector.update(scene)
+            finally:
+                selector.shutdown()
+            self.assertEqual(len(selector.visible_meshes), (draw.any(axis=1) & inside).sum())
+            for mesh, instance, drawn in zip(meshes, draw, inside):
+                self.assertEqual(mesh.clusters, set(np.flatnonzero(instance).tolist()) if drawn else set())
+
+    def test_parallel_lod(self):
+        config = {
+            "cluster_size_initial": 160,
+            "cluster_size": 128,
+            "group_size": 8
+        }
+
+        vertices, tris, adj = create_grid_mesh_tris(size=(64, 64))
+        adjacencies, clusters = group_tris(tris, cluster_size=94)
+        lod = [vertices, tris, adjacencies, clusters, [], [], np.zeros_like(vertices)]
+
+        serial = next_lod(lod, config, num_workers=1)
+        parallel = next_lod(lod, config, num_workers=2)
+        for a, b in [(serial[0], parallel[0]), (serial[1], parallel[1]), (serial[3], parallel[3])]:
+            self.assertTrue(np.array_equal(a, b))
+        self.assertEqual(serial[5], parallel[5])
+
 
 if __name__ == "__main__":
     unittest.main()